@@ -12,26 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import contextlib
 import functools
+import hashlib
 import sqlite3
 import os
 import json
 import struct
 import tempfile
 import threading
+import time
 
-from typing import Dict, Iterator, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+from collections import OrderedDict, defaultdict
+from typing import (Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence,
+                    Tuple, Union)
 
 import dimod
 import homebase
 import networkx as nx
 import numpy as np
 
+from dimod.typing import Variable
+
 from penaltymodel import __version__
 from penaltymodel.exceptions import MissingPenaltyModel
 from penaltymodel.typing import GraphLike
-from penaltymodel.utils import as_graph
+from penaltymodel.utils import as_graph, spin_reversals
 
 __all__ = ['PenaltyModelCache']
 
@@ -48,6 +55,190 @@ class PenaltyModel(NamedTuple):
     classical_gap: float
 
 
+class MemoryCache:
+    """A thread-safe LRU cache of decoded penalty models.
+
+    Used by :class:`PenaltyModelCache` to avoid reading and decoding the
+    same penalty models repeatedly.
+
+    Args:
+        maxsize: The maximum number of penalty models kept.
+        max_bytes: The maximum total size of the serialized binary quadratic
+            models kept.
+
+    """
+
+    def __init__(self, maxsize: int = 1024, max_bytes: int = 1 << 26):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()  # key -> (bqm, gap, nbytes)
+        self._keys = defaultdict(set)  # (database, spec_hash) -> keys
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Tuple) -> Optional[Tuple[dimod.BinaryQuadraticModel, float]]:
+        """Return a copy of the penalty model for ``key``, or ``None`` if there isn't one."""
+        with self._lock:
+            try:
+                bqm, gap, _ = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+        return bqm.copy(), gap
+
+    def put(self, key: Tuple, bqm: dimod.BinaryQuadraticModel, gap: float, nbytes: int):
+        """Keep a copy of a penalty model for ``key``.
+
+        The first two elements of ``key`` must be the database and the spec
+        hash, see :meth:`invalidate`.
+        """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = bqm.copy(), gap, nbytes
+            self._keys[key[:2]].add(key)
+            self.nbytes += nbytes
+
+            while len(self._entries) > self.maxsize or self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+            keys = self._keys[key[:2]]
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[:2]]
+
+    def invalidate(self, database: str, spec_hash: bytes):
+        """Forget the penalty models of a spec, because a new one was inserted."""
+        with self._lock:
+            for key in list(self._keys.get((database, spec_hash), ())):
+                self._remove(key)
+
+    def clear(self):
+        """Forget every penalty model."""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self.nbytes = 0
+
+
+@functools.lru_cache(maxsize=1024)
+def canonical_form(num_nodes: int,
+                   edges: Tuple[Tuple[int, int], ...],
+                   num_decision: int,
+                   samples: bytes,
+                   energies: bytes,
+                   max_leaves: int = 1000,
+                   ) -> Optional[Tuple[Tuple[int, ...], Tuple[bool, ...]]]:
+    """Return a canonical order and spin reversal for a penalty model specification.
+
+    The nodes are labelled ``range(num_nodes)``, with the decision variables
+    first. ``samples`` is a C-ordered boolean array of the feasible states
+    of the decision variables and ``energies`` their float64 energies.
+
+    Returns a 2-tuple. The first is an order for the nodes, with the
+    decision variables first. The second says which decision variables to
+    flip, see :func:`~penaltymodel.utils.spin_reversals`. Two
+    specifications that differ only by a relabelling of the decision
+    variables amongst themselves, of the auxiliary variables amongst
+    themselves, and by flipping some of the decision variables, give the
+    same specification once flipped and put in order.
+
+    The order is found by colour refinement, branching on the nodes that
+    it cannot tell apart. ``None`` is returned if that takes more than
+    ``max_leaves`` branches over all of the spin reversals tried, which only
+    happens for very symmetric specifications. Like
+    :func:`penaltymodel.generation.automorphism_domain`, the result is
+    cached by its arguments.
+
+    """
+    adjacency = [[] for _ in range(num_nodes)]
+    for u, v in edges:
+        adjacency[u].append(v)
+        adjacency[v].append(u)
+
+    energy = np.frombuffer(energies, dtype='<f8')
+    samples = np.frombuffer(samples, dtype=bool).reshape(len(energy), num_decision)
+
+    def rank(signatures):
+        ranks = {signature: i for i, signature in enumerate(sorted(set(signatures)))}
+        return [ranks[signature] for signature in signatures]
+
+    best = None
+    leaves = 0
+
+    for flips in spin_reversals(samples):
+        table = samples ^ flips
+
+        # how often each pair of decision variables agree, less how often they don't
+        spins = 2 * table.astype(np.int64) - 1
+        agreement = (spins.T @ spins).tolist()
+        ones = table.sum(axis=0).tolist()
+
+        def refine(colors):
+            # the old colour comes first in each signature, so cells only split
+            while True:
+                refined = rank([(colors[v],
+                                 tuple(sorted(colors[u] for u in adjacency[v])),
+                                 tuple(sorted((colors[u], agreement[v][u])
+                                              for u in range(num_decision) if u != v)
+                                       if v < num_decision else ()))
+                                for v in range(num_nodes)])
+                if max(refined, default=-1) == max(colors, default=-1):
+                    return refined
+                colors = refined
+
+        def leaf_key(order):
+            position = [0] * num_nodes
+            for i, v in enumerate(order):
+                position[v] = i
+            relabelled = sorted(tuple(sorted((position[u], position[v]))) for u, v in edges)
+            packed = table[:, order[:num_decision]] @ (1 << np.arange(num_decision, dtype=np.int64))
+            return relabelled, sorted(zip(packed.tolist(), energy.tolist()))
+
+        def search(colors) -> bool:
+            # return False once there have been too many leaves
+            nonlocal best, leaves
+
+            colors = refine(colors)
+
+            cells = defaultdict(list)
+            for v, color in enumerate(colors):
+                cells[color].append(v)
+            target = min((color for color, cell in cells.items() if len(cell) > 1), default=None)
+
+            if target is None:
+                leaves += 1
+                order = sorted(range(num_nodes), key=colors.__getitem__)
+                key = leaf_key(order)
+                if best is None or key < best[0]:
+                    best = key, order, flips
+                return leaves <= max_leaves
+
+            # try putting each node of the first ambiguous cell first in it
+            return all(search(rank([(color, color != target or u != v)
+                                    for u, color in enumerate(colors)]))
+                       for v in cells[target])
+
+        # decision variables come first and are told apart by how often they are 1
+        colors = rank([(0, ones[v], len(adjacency[v])) if v < num_decision
+                       else (1, 0, len(adjacency[v]))
+                       for v in range(num_nodes)])
+        if not search(colors):
+            return None
+
+    _, order, flips = best
+    return tuple(order), tuple(flips.tolist())
+
+
 class PenaltyModelCache(contextlib.AbstractContextManager):
     """Manage a database of penalty models.
 
@@ -66,6 +257,31 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
             If the special database name ':memory:' is given, then a temporary
             database is created in memory.
 
+        shared:
+            If ``True``, use the calling thread's shared connection to the
+            database, opening it if needed. Shared connections stay open
+            when the cache is closed, so that later caches can reuse them,
+            until :meth:`close_shared_connections` is called.
+
+        timeout:
+            How long, in seconds, to wait for other connections to release
+            the database before raising an error. Writes that still find it
+            locked are retried ``PenaltyModelCache.retries`` more times.
+            Defaults to ``PenaltyModelCache.timeout``.
+
+        memory:
+            If ``True``, penalty models retrieved from a database file are
+            kept in ``PenaltyModelCache.memory_cache``, a process-wide
+            :class:`MemoryCache`, and later retrievals of the same
+            specification return a copy from memory. Inserting a penalty
+            model in this process forgets the ones kept for its
+            specification. Penalty models inserted by other processes are
+            not seen until the kept ones are evicted.
+
+    Database files use write-ahead logging, so that any number of processes
+    can read the cache while one of them writes to it. Each insertion is a
+    single short write transaction.
+
     """
 
     database_schema = \
@@ -73,7 +289,7 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         CREATE TABLE IF NOT EXISTS graph(
             num_nodes INTEGER NOT NULL,
             num_edges INTEGER NOT NULL,
-            edges TEXT NOT NULL,  -- json list of lists, should be sorted (with each edge sorted)
+            edges BLOB NOT NULL,  -- little-endian uint32 pairs, sorted (with each edge sorted)
             id INTEGER PRIMARY KEY,
             CONSTRAINT graph UNIQUE (num_nodes, edges)
         );
@@ -81,8 +297,8 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         CREATE TABLE IF NOT EXISTS sampleset(
             num_variables INTEGER NOT NULL,
             num_samples INTEGER NOT NULL,
-            samples TEXT NOT NULL,
-            energies BLOB NOT NULL,
+            samples BLOB NOT NULL,  -- little-endian uint32 rows, see encode_sampleset
+            energies BLOB NOT NULL,  -- little-endian float64
             id INTEGER PRIMARY KEY,
             CONSTRAINT sampleset UNIQUE (
                 num_variables,
@@ -107,6 +323,7 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
             classical_gap REAL NOT NULL,
             sampleset_id INT,
             bqm_id INT,
+            spec_hash BLOB,  -- see encode_spec
             id INTEGER PRIMARY KEY,
             CONSTRAINT penalty_model UNIQUE (decision_variables, sampleset_id, bqm_id),
             FOREIGN KEY (sampleset_id) REFERENCES sampleset(id) ON DELETE CASCADE,
@@ -146,6 +363,13 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         PRAGMA foreign_keys = ON;
         """
 
+    # run after the schema, so that databases created before the spec_hash
+    # column existed can be migrated first
+    database_index = \
+        """
+        CREATE INDEX IF NOT EXISTS penalty_model_spec_hash ON penalty_model(spec_hash);
+        """
+
     insert_bqm_statement = \
         """
         INSERT OR IGNORE INTO binary_quadratic_model(
@@ -180,12 +404,14 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
             decision_variables,
             classical_gap,
             sampleset_id,
-            bqm_id)
+            bqm_id,
+            spec_hash)
         SELECT
             :decision_variables,
             :classical_gap,
             sampleset.id,
-            binary_quadratic_model.id
+            binary_quadratic_model.id,
+            :spec_hash
         FROM sampleset, binary_quadratic_model, graph
         WHERE
             graph.edges = :edges AND
@@ -212,33 +438,218 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         """
 
     database_name = f'penaltymodel_v{__version__}.db'
+
+    # stored as the database's user_version, see _migrate
+    schema_version = 4
     database_path = homebase.user_data_dir(app_name='dwave-penaltymodel-cache',
                                            app_author='dwave-systems',
                                            create=True,
                                            )
 
-    def __init__(self, database: Optional[Union[str, os.PathLike]] = None):
+    # the connections shared by each thread, by process and then database. A
+    # process started with fork inherits the connections of its parent, which
+    # sqlite does not allow it to use or close, so they are set aside
+    _shared = threading.local()
+
+    timeout = 30.
+    retries = 3
+
+    # the most specs looked up by a single query in retrieve_many, to stay
+    # under sqlite's limit on the number of parameters
+    max_query_size = 500
+
+    # the decoded penalty models of every database, see MemoryCache
+    memory_cache = MemoryCache()
+
+    # the databases whose schema has already been created by this process
+    _initialized = set()
+    _initialized_lock = threading.Lock()
+
+    def __init__(self,
+                 database: Optional[Union[str, os.PathLike]] = None,
+                 *,
+                 shared: bool = False,
+                 timeout: Optional[float] = None,
+                 memory: bool = False,
+                 ):
         if database is None:
             database = os.path.join(self.database_path, self.database_name)
-        self.conn = conn = sqlite3.connect(database)
+        self.database = database = os.fspath(database)
+
+        if timeout is None:
+            timeout = self.timeout
+
+        # every in-memory database is different, so there's nothing to share
+        self.memory = memory and database != ':memory:'
+
+        self.shared = shared
+        if shared:
+            connections = self._shared_connections()
+            if database in connections:
+                self.conn = connections[database]
+                self.conn.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)};")
+            else:
+                self.conn = connections[database] = self._connect(database, timeout)
+        else:
+            self.conn = self._connect(database, timeout)
 
-        # add the main schema
-        conn.executescript(self.database_schema)
+    @classmethod
+    def _connect(cls, database: str, timeout: float) -> sqlite3.Connection:
+        # sqlite creates the file if it does not exist, so check first
+        exists = database != ':memory:' and os.path.exists(database)
+
+        conn = sqlite3.connect(database, timeout=timeout)
 
         # give us mapping access to values returned by .execute
         conn.row_factory = sqlite3.Row
 
+        # add the main schema, unless we've already done it for this file
+        with cls._initialized_lock:
+            if exists and database in cls._initialized:
+                conn.execute("PRAGMA foreign_keys = ON;")
+            else:
+                if database != ':memory:':
+                    # this is stored in the file, so only needs to be done once
+                    if conn.execute("PRAGMA journal_mode;").fetchone()[0] != 'wal':
+                        conn.execute("PRAGMA journal_mode = WAL;")
+                conn.executescript(cls.database_schema)
+                cls._migrate(conn)
+                conn.executescript(cls.database_index)
+                if database != ':memory:':
+                    cls._initialized.add(database)
+
+        # with WAL, the database cannot be corrupted by a crash without a
+        # full sync, at worst the latest transactions are lost
+        conn.execute("PRAGMA synchronous = NORMAL;")
+
+        return conn
+
+    @classmethod
+    @contextlib.contextmanager
+    def _transaction(cls, conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+        # take the write lock up front, so the transaction cannot fail
+        # part-way through because another connection wrote first
+        for attempt in range(cls.retries + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+                break
+            except sqlite3.OperationalError as err:
+                if 'locked' not in str(err) or attempt == cls.retries:
+                    raise
+                time.sleep(.1 * 2**attempt)
+
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    @classmethod
+    def _migrate(cls, conn: sqlite3.Connection):
+        # bring databases written by older versions of the schema up to date
+        with cls._transaction(conn):
+            # check inside the transaction, in case another process got here first
+            if conn.execute("PRAGMA user_version;").fetchone()[0] >= cls.schema_version:
+                return
+
+            # databases created before the spec_hash column need it added
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(penalty_model);")]
+            if 'spec_hash' not in columns:
+                conn.execute("ALTER TABLE penalty_model ADD COLUMN spec_hash BLOB;")
+
+            # before version 1, edges and samples were stored as json text
+            conn.executemany(
+                "UPDATE graph SET edges = ? WHERE id = ?;",
+                [(np.asarray(json.loads(row['edges']), dtype='<u4').tobytes(), row['id'])
+                 for row in conn.execute(
+                     "SELECT id, edges FROM graph WHERE typeof(edges) = 'text';")])
+            conn.executemany(
+                "UPDATE sampleset SET samples = ? WHERE id = ?;",
+                [(np.asarray(json.loads(row['samples']), dtype='<u4').tobytes(), row['id'])
+                 for row in conn.execute(
+                     "SELECT id, samples FROM sampleset WHERE typeof(samples) = 'text';")])
+
+            # before version 2, bqms were stored in dimod's file format
+            converted: Dict[Tuple[int, bytes], int] = {}
+            for row in conn.execute(
+                    "SELECT id, graph_id, bqm_data FROM binary_quadratic_model;").fetchall():
+                if not row['bqm_data'].startswith(b'DIMODBQM'):
+                    continue
+                bqm = dimod.BinaryQuadraticModel.from_file(row['bqm_data'])
+                bqm_data = cls.encode_bqm(bqm)['bqm_data']
+                key = (row['graph_id'], bqm_data)
+                if key in converted:
+                    # the same bqm, written by different versions of dimod
+                    conn.execute("UPDATE OR IGNORE penalty_model SET bqm_id = ? WHERE bqm_id = ?;",
+                                 (converted[key], row['id']))
+                    conn.execute("DELETE FROM binary_quadratic_model WHERE id = ?;", (row['id'],))
+                else:
+                    converted[key] = row['id']
+                    conn.execute("UPDATE binary_quadratic_model SET bqm_data = ? WHERE id = ?;",
+                                 (bqm_data, row['id']))
+
+            # before version 3, penalty models were not stored in their
+            # canonical order, and before version 4 they were not flipped to
+            # their canonical form, so re-encode them. This also fills in the
+            # spec hashes. The graphs, sample sets and bqms they were stored
+            # with are left in place.
+            parameters = [cls.encode_penalty_model(cls.decode_bqm(row), cls.decode_sampleset(row),
+                                                   row['classical_gap'])
+                          for row in conn.execute("SELECT * FROM penalty_model_view;").fetchall()]
+            conn.execute("DELETE FROM penalty_model;")
+            conn.executemany(cls.insert_graph_statement, parameters)
+            conn.executemany(cls.insert_bqm_statement, parameters)
+            conn.executemany(cls.insert_sampleset_statement, parameters)
+            conn.executemany(cls.insert_penalty_model_statement, parameters)
+
+            conn.execute(f"PRAGMA user_version = {cls.schema_version:d};")
+
+    @classmethod
+    def _shared_connections(cls) -> Dict[str, sqlite3.Connection]:
+        try:
+            processes = cls._shared.processes
+        except AttributeError:
+            processes = cls._shared.processes = {}
+        return processes.setdefault(os.getpid(), {})
+
+    @classmethod
+    def close_shared_connections(cls, database: Optional[Union[str, os.PathLike]] = None):
+        """Close the calling thread's shared connections.
+
+        Args:
+            database:
+                Only close the shared connection to this database. If not
+                given, close all of them.
+
+        """
+        connections = cls._shared_connections()
+        if database is None:
+            databases = list(connections)
+        else:
+            databases = [os.fspath(database)]
+
+        for database in databases:
+            conn = connections.pop(database, None)
+            if conn is not None:
+                conn.close()
+
     def __exit__(self, *args):
         # todo: make reentrant
         self.close()
 
     def close(self):
-        """Close the database connection."""
-        self.conn.close()
+        """Close the database connection.
+
+        Shared connections are left open for reuse.
+        """
+        if not self.shared:
+            self.conn.close()
 
     @staticmethod
     def encode_graph(graph_like: Union[GraphLike, dimod.BinaryQuadraticModel]
-                     ) -> Dict[str, Union[int, str]]:
+                     ) -> Dict[str, Union[int, bytes]]:
         """Encode a NetworkX graph or BQM to be stored in the cache."""
         if isinstance(graph_like, dimod.BinaryQuadraticModel):
             nodes = graph_like.linear.keys()
@@ -254,15 +665,34 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         return dict(
             num_nodes=len(nodes),
             num_edges=len(edges),
-            edges=json.dumps(sorted(map(sorted, edges)), separators=(',', ':')),
+            edges=np.asarray(sorted(map(sorted, edges)), dtype='<u4').tobytes(),
             )
 
     @staticmethod
-    def decode_graph(row: Dict[str, Union[int, str]]) -> nx.Graph:
+    def encode_spec(parameters: Mapping[str, Union[int, str, bytes]]) -> bytes:
+        """Hash the encoded graph, sample set and decision variables of a penalty model.
+
+        Penalty models with the same hash are looked up together.
+        """
+        spec = hashlib.blake2b(digest_size=16)
+        for key in ['num_nodes', 'edges', 'num_variables', 'samples', 'energies',
+                    'decision_variables']:
+            value = parameters[key]
+            if isinstance(value, int):
+                value = str(value)
+            if isinstance(value, str):
+                value = value.encode()
+            # prefix the length so that the fields cannot run together
+            spec.update(struct.pack('<Q', len(value)))
+            spec.update(value)
+        return spec.digest()
+
+    @staticmethod
+    def decode_graph(row: Dict[str, Union[int, bytes]]) -> nx.Graph:
         """Decode a row in the cache to a NetworkX graph."""
         graph = nx.Graph()
         graph.add_nodes_from(range(row['num_nodes']))
-        graph.add_edges_from(json.loads(row['edges']))
+        graph.add_edges_from(np.frombuffer(row['edges'], dtype='<u4').reshape(-1, 2).tolist())
         return graph
 
     def insert_graph(self, graph_like: GraphLike):
@@ -275,7 +705,7 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
             ValueError: If the nodes of the graph are not labelled `[0, n)`.
 
         """
-        with self.conn as cur:
+        with self._transaction(self.conn) as cur:
             cur.execute(self.insert_graph_statement, self.encode_graph(graph_like))
 
     def iter_graphs(self) -> Iterator[nx.Graph]:
@@ -288,7 +718,8 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         yield from map(self.decode_graph, self.conn.execute("SELECT num_nodes, edges from graph;"))
 
     @staticmethod
-    def encode_sampleset(samples_like) -> Dict[str, Union[int, str, bytes]]:
+    def encode_sampleset(samples_like, energies: Optional[np.ndarray] = None
+                         ) -> Dict[str, Union[int, bytes]]:
         samples, labels = dimod.as_samples(samples_like)
 
         if not all(i == v for i, v in enumerate(labels)):
@@ -301,7 +732,9 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         if num_variables > 32:
             raise ValueError("sample set must have 32 or fewer variables")
 
-        if isinstance(samples_like, dimod.SampleSet):
+        if energies is not None:
+            energies = np.asarray(energies)
+        elif isinstance(samples_like, dimod.SampleSet):
             energies = samples_like.record.energy
         else:
             energies = np.zeros(num_samples)
@@ -310,26 +743,28 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         samples = samples[order, :]
         energies = energies[order]
 
-        packed = dimod.serialization.utils.pack_samples(samples > 0).flatten().tolist()
+        # one uint32 per sample, with the first variable in the lowest bit
+        packed = dimod.serialization.utils.pack_samples(samples > 0)
 
         return dict(
             num_variables=num_variables,
             num_samples=num_samples,
-            samples=json.dumps(packed, separators=(',', ':')),
-            energies=struct.pack('<' + 'd' * len(energies), *energies),
+            samples=packed.astype('<u4', copy=False).tobytes(),
+            energies=np.asarray(energies, dtype='<f8').tobytes(),
             )
 
     @staticmethod
-    def decode_sampleset(row: Dict[str, Union[int, str, bytes]]) -> dimod.SampleSet:
+    def decode_sampleset(row: Dict[str, Union[int, bytes]]) -> dimod.SampleSet:
         num_variables = row['num_variables']
 
-        packed = np.atleast_2d(json.loads(row['samples'])).transpose()
+        num_words = -(-num_variables // 32)  # 0 or 1
+        packed = np.frombuffer(row['samples'], dtype='<u4').reshape(row['num_samples'], num_words)
         samples = dimod.serialization.utils.unpack_samples(packed, num_variables, dtype=np.int8)
 
         # convert to SPIN
         samples = 2*samples-1
 
-        energies = struct.unpack('<' + 'd' * (len(row['energies']) // 8), row['energies'])
+        energies = np.frombuffer(row['energies'], dtype='<f8')
 
         return dimod.SampleSet.from_samples(samples, vartype='SPIN', energy=energies)
 
@@ -348,7 +783,7 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         .. _array_like: https://numpy.org/doc/stable/user/basics.creation.html
 
         """
-        with self.conn as cur:
+        with self._transaction(self.conn) as cur:
             cur.execute(self.insert_sampleset_statement, self.encode_sampleset(samples_like))
 
     def iter_samplesets(self):
@@ -358,18 +793,49 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
 
     @staticmethod
     def encode_bqm(bqm: dimod.BinaryQuadraticModel) -> Dict[str, Union[float, bytes]]:
-        with bqm.to_file() as f:
-            return dict(
-                max_quadratic_bias=bqm.quadratic.max(),
-                min_quadratic_bias=bqm.quadratic.min(),
-                max_linear_bias=bqm.linear.max(),
-                min_linear_bias=bqm.linear.min(),
-                bqm_data=f.read(),
-                )
+        """Encode an index-labelled BQM to be stored in the cache.
+
+        The BQM is stored as SPIN, as a header with the number of variables,
+        the number of interactions and the offset, followed by the linear
+        biases, the quadratic biases and the row and column indices of the
+        interactions, all little-endian.
+        """
+        if bqm.vartype is not dimod.SPIN:
+            bqm = bqm.change_vartype(dimod.SPIN, inplace=False)
+
+        linear, (irow, icol, quadratic), offset = bqm.to_numpy_vectors(
+            range(bqm.num_variables), sort_indices=True)
+
+        return dict(
+            max_quadratic_bias=bqm.quadratic.max(),
+            min_quadratic_bias=bqm.quadratic.min(),
+            max_linear_bias=bqm.linear.max(),
+            min_linear_bias=bqm.linear.min(),
+            bqm_data=b''.join([struct.pack('<IId', len(linear), len(quadratic), offset),
+                               linear.astype('<f8', copy=False).tobytes(),
+                               quadratic.astype('<f8', copy=False).tobytes(),
+                               irow.astype('<u4').tobytes(),
+                               icol.astype('<u4').tobytes()]),
+            )
 
     @staticmethod
     def decode_bqm(row: Dict[str, Union[bytes, str, int]]) -> dimod.BinaryQuadraticModel:
-        return dimod.BinaryQuadraticModel.from_file(row['bqm_data'])
+        """Decode a row in the cache to a SPIN-valued BQM, see :meth:`encode_bqm`."""
+        data = memoryview(row['bqm_data'])
+        num_variables, num_interactions, offset = struct.unpack_from('<IId', data)
+
+        # views over the row, from_numpy_vectors makes the only copy
+        start = struct.calcsize('<IId')
+        linear = np.frombuffer(data, dtype='<f8', count=num_variables, offset=start)
+        start += linear.nbytes
+        quadratic = np.frombuffer(data, dtype='<f8', count=num_interactions, offset=start)
+        start += quadratic.nbytes
+        irow = np.frombuffer(data, dtype='<u4', count=num_interactions, offset=start)
+        start += irow.nbytes
+        icol = np.frombuffer(data, dtype='<u4', count=num_interactions, offset=start)
+
+        return dimod.BinaryQuadraticModel.from_numpy_vectors(
+            linear, (irow, icol, quadratic), offset, dimod.SPIN)
 
     def insert_binary_quadratic_model(self, bqm: dimod.BinaryQuadraticModel):
         """Insert a binary quadratic model into the database.
@@ -400,7 +866,7 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         parameters = self.encode_graph(bqm)
         parameters.update(self.encode_bqm(bqm))
 
-        with self.conn as cur:
+        with self._transaction(self.conn) as cur:
             cur.execute(self.insert_graph_statement, parameters)
             cur.execute(self.insert_bqm_statement, parameters)
 
@@ -430,35 +896,84 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
         .. _array_like: https://numpy.org/doc/stable/user/basics.creation.html
 
         """
+        self.insert_penalty_models([(bqm, samples_like, classical_gap)])
 
-        samples, decision = samples_like = dimod.as_samples(samples_like)
+    def insert_penalty_models(
+            self,
+            penalty_models: Iterable[Tuple[dimod.BinaryQuadraticModel, Any, float]],
+            *,
+            workers: int = 1,
+            ):
+        """Insert many penalty models into the database in a single transaction.
+
+        Args:
+            penalty_models: ``(bqm, samples_like, classical_gap)`` tuples,
+                see :meth:`insert_penalty_model`.
+
+            workers: If greater than one, the penalty models are encoded in
+                a process pool before being written.
+
+        """
+        penalty_models = list(penalty_models)
+        if not penalty_models:
+            return
+
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                chunksize = max(len(penalty_models) // (4 * workers), 1)
+                parameters = list(executor.map(self.encode_penalty_model, *zip(*penalty_models),
+                                               chunksize=chunksize))
+        else:
+            parameters = [self.encode_penalty_model(*penalty_model)
+                          for penalty_model in penalty_models]
+
+        with self._transaction(self.conn) as cur:
+            cur.executemany(self.insert_graph_statement, parameters)
+            cur.executemany(self.insert_bqm_statement, parameters)
+            cur.executemany(self.insert_sampleset_statement, parameters)
+            cur.executemany(self.insert_penalty_model_statement, parameters)
+
+        # the new penalty models might be better than the ones we kept
+        for spec_hash in set(p['spec_hash'] for p in parameters):
+            self.memory_cache.invalidate(self.database, spec_hash)
+
+    @classmethod
+    def encode_penalty_model(cls,
+                             bqm: dimod.BinaryQuadraticModel,
+                             samples_like,
+                             classical_gap: float,
+                             ) -> Dict[str, Union[int, float, str, bytes]]:
+        """Encode a penalty model to be stored in the cache.
+
+        The penalty model is relabelled and flipped to its canonical form
+        first, see :func:`canonical_form`.
+        """
+        samples, decision = dimod.as_samples(samples_like)
+        energies = samples_like.record.energy if isinstance(samples_like, dimod.SampleSet) else None
 
         # do some input checking
         if not all(v in bqm.variables for v in decision):
             raise ValueError("bqm's variables must be a superset of the "
                              "samples_like's variables")
 
-        # we need the variables to be labelled [0, n) and for the decision
-        # variables to be sorted
-        if bqm.variables ^ range(bqm.num_variables) or any(i != v for i, v in enumerate(decision)):
-            mapping = {v: i for i, v in enumerate(decision)}
-            mapping.update((v, i) for i, v in enumerate(bqm.variables ^ decision, len(mapping)))
-
-            return self.insert_penalty_model(bqm.relabel_variables(mapping, inplace=False), samples, classical_gap)
-
-        parameters = self.encode_graph(bqm)
-        parameters.update(self.encode_bqm(bqm))
-        parameters.update(self.encode_sampleset(samples_like))
+        graph = nx.Graph()
+        graph.add_nodes_from(bqm.variables)
+        graph.add_edges_from(bqm.quadratic)
+        mapping, graph, samples, energies, flipped = cls._canonicalize(graph, samples, decision,
+                                                                       energies)
+        bqm = bqm.relabel_variables(mapping, inplace=False)
+        for v in flipped:
+            bqm.flip_variable(mapping[v])
+
+        parameters = cls.encode_graph(graph)
+        parameters.update(cls.encode_bqm(bqm))
+        parameters.update(cls.encode_sampleset((samples, range(len(decision))), energies))
         parameters.update(
-            decision_variables=json.dumps(decision, separators=(',', ':')),
+            decision_variables=json.dumps(list(range(len(decision))), separators=(',', ':')),
             classical_gap=classical_gap,
             )
-
-        with self.conn as cur:
-            cur.execute(self.insert_graph_statement, parameters)
-            cur.execute(self.insert_bqm_statement, parameters)
-            cur.execute(self.insert_sampleset_statement, parameters)
-            cur.execute(self.insert_penalty_model_statement, parameters)
+        parameters.update(spec_hash=cls.encode_spec(parameters))
+        return parameters
 
     def iter_penalty_models(self) -> Iterator[PenaltyModel]:
         """Iterate over all of the penalty models in the database."""
@@ -479,6 +994,16 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
                  ) -> Tuple[dimod.BinaryQuadraticModel, float]:
         """Retrieve a penalty model from the database.
 
+        Penalty models are stored in a canonical form, so a penalty model
+        is found however its decision variables and auxiliary variables are
+        labelled and ordered, and for any table that differs from its own by
+        flipping some of the decision variables. The binary quadratic model
+        is relabelled and flipped to match ``samples_like`` and
+        ``graph_like``. Flipping a variable negates its linear bias and the
+        quadratic biases of its interactions, so if the bounds are not
+        symmetric about zero, they are checked after the penalty model is
+        flipped.
+
         Args:
             samples_like:
                 The set of feasible states that form the ground states of the
@@ -527,7 +1052,211 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
             that the binary quadratic model always has vartype ``'SPIN'``.
 
         """
+        (penalty_model,), _ = self.retrieve_many([(samples_like, graph_like)],
+                                                 linear_bound=linear_bound,
+                                                 quadratic_bound=quadratic_bound,
+                                                 min_classical_gap=min_classical_gap)
+        if penalty_model is None:
+            raise MissingPenaltyModel(
+                "no penalty model with the given specification found in cache")
+        return penalty_model
+
+    def retrieve_many(self,
+                      specs: Iterable[Tuple[Any, GraphLike]],
+                      *,
+                      linear_bound: Tuple[float, float] = (-2, 2),
+                      quadratic_bound: Tuple[float, float] = (-1, 1),
+                      min_classical_gap: float = 2,
+                      ) -> Tuple[List[Optional[Tuple[dimod.BinaryQuadraticModel, float]]],
+                                 List[int]]:
+        """Retrieve many penalty models from the database.
+
+        The specifications are looked up together, with one query per
+        ``PenaltyModelCache.max_query_size`` distinct specifications.
+
+        Args:
+            specs:
+                ``(samples_like, graph_like)`` pairs, see :meth:`retrieve`.
+
+            linear_bound:
+                The range allowed for the linear biases of the binary
+                quadratic models.
+
+            quadratic_bound:
+                The range allowed for the quadratic biases of the binary
+                quadratic models.
+
+            min_classical_gap:
+                The minimum classical gap of the penalty models.
+
+        Returns:
+            A 2-tuple. The first is a list with the binary quadratic model
+            and classical gap of each specification, as returned by
+            :meth:`retrieve`, or ``None`` if it is not in the database. The
+            second is the list of the indices of the specifications that
+            are not in the database.
+
+        """
+        linear_bound = tuple(linear_bound)
+        quadratic_bound = tuple(quadratic_bound)
+        symmetric = (linear_bound[0] == -linear_bound[1]
+                     and quadratic_bound[0] == -quadratic_bound[1])
+
+        # (spec_hash, flips) for each spec. Flipping a variable negates some
+        # of the biases, so unless the bounds are symmetric, the bounds of the
+        # stored penalty models are checked after they are flipped, and the
+        # (canonical) variables flipped are part of the key
+        keys = []
+        inverse_mappings = []
+        flips = []
+        for samples_like, graph_like in specs:
+            spec_hash, mapping, flipped = self._encode_query(samples_like, graph_like)
+            if flipped and not symmetric:
+                keys.append((spec_hash, tuple(sorted(v if mapping is None else mapping[v]
+                                                     for v in flipped))))
+            else:
+                keys.append((spec_hash, ()))
+            inverse_mappings.append(None if mapping is None
+                                    else dict((i, v) for v, i in mapping.items()))
+            flips.append(flipped)
+
+        def memory_key(key):
+            return (self.database, *key, linear_bound, quadratic_bound, min_classical_gap)
+
+        # the best penalty model for each distinct spec, as stored
+        found: Dict[Tuple, Optional[Tuple[dimod.BinaryQuadraticModel, float]]] = {}
+        if self.memory:
+            for key in set(keys):
+                penalty_model = self.memory_cache.get(memory_key(key))
+                if penalty_model is not None:
+                    found[key] = penalty_model
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+
+        # the specs whose stored penalty models can be filtered by bounds in
+        # the query, with the best one for each picked by sqlite
+        direct = [spec_hash for spec_hash, flipped in missing if not flipped]
+        for start in range(0, len(direct), self.max_query_size):
+            chunk = direct[start:start + self.max_query_size]
+
+            # sqlite returns the other columns from the row with the max gap
+            query = f"""
+                SELECT spec_hash, bqm_data, MAX(classical_gap) AS classical_gap
+                FROM penalty_model, binary_quadratic_model
+                WHERE
+                    -- graph, feasible_configurations and decision variables:
+                    spec_hash IN ({', '.join('?' * len(chunk))}) AND
+                    binary_quadratic_model.id = penalty_model.bqm_id AND
+                    -- bounds
+                    min_linear_bias >= ? AND
+                    max_linear_bias <= ? AND
+                    min_quadratic_bias >= ? AND
+                    max_quadratic_bias <= ? AND
+                    -- gap
+                    classical_gap >= ?
+                GROUP BY spec_hash;
+                """
+            parameters = chunk + [*linear_bound, *quadratic_bound, min_classical_gap]
+
+            for row in self.conn.execute(query, parameters):
+                key = (row['spec_hash'], ())
+                bqm = self.decode_bqm(row)
+                found[key] = bqm, row['classical_gap']
+                if self.memory:
+                    self.memory_cache.put(memory_key(key), bqm, row['classical_gap'],
+                                          len(row['bqm_data']))
+
+        # the others get every stored penalty model that could be within the
+        # bounds either way round, best first, which are then flipped and
+        # checked one by one
+        candidates = defaultdict(list)
+        for spec_hash, flipped in missing:
+            if flipped:
+                candidates[spec_hash].append(flipped)
+        spec_hashes = list(candidates)
+        for start in range(0, len(spec_hashes), self.max_query_size):
+            chunk = spec_hashes[start:start + self.max_query_size]
+
+            query = f"""
+                SELECT spec_hash, bqm_data, classical_gap
+                FROM penalty_model, binary_quadratic_model
+                WHERE
+                    spec_hash IN ({', '.join('?' * len(chunk))}) AND
+                    binary_quadratic_model.id = penalty_model.bqm_id AND
+                    min_linear_bias >= ? AND
+                    max_linear_bias <= ? AND
+                    min_quadratic_bias >= ? AND
+                    max_quadratic_bias <= ? AND
+                    classical_gap >= ?
+                ORDER BY classical_gap DESC;
+                """
+            parameters = chunk + [min(linear_bound[0], -linear_bound[1]),
+                                  max(linear_bound[1], -linear_bound[0]),
+                                  min(quadratic_bound[0], -quadratic_bound[1]),
+                                  max(quadratic_bound[1], -quadratic_bound[0]),
+                                  min_classical_gap]
+
+            for row in self.conn.execute(query, parameters):
+                unfound = [flipped for flipped in candidates[row['spec_hash']]
+                           if (row['spec_hash'], flipped) not in found]
+                if not unfound:
+                    continue
+                bqm = self.decode_bqm(row)
+                for flipped in unfound:
+                    if self._within_bounds(bqm, flipped, linear_bound, quadratic_bound):
+                        key = (row['spec_hash'], flipped)
+                        found[key] = bqm, row['classical_gap']
+                        if self.memory:
+                            self.memory_cache.put(memory_key(key), bqm, row['classical_gap'],
+                                                  len(row['bqm_data']))
+
+        penalty_models: List[Optional[Tuple[dimod.BinaryQuadraticModel, float]]] = []
+        misses = []
+        used = set()
+        for i, (key, inverse_mapping, flipped) in enumerate(zip(keys, inverse_mappings, flips)):
+            if key not in found:
+                penalty_models.append(None)
+                misses.append(i)
+                continue
+
+            # don't share the bqm between repeated specs
+            bqm, gap = found[key]
+            if inverse_mapping is not None:
+                bqm = bqm.relabel_variables(inverse_mapping, inplace=False)
+            elif flipped or id(bqm) in used:
+                bqm = bqm.copy()
+            used.add(id(found[key][0]))
+
+            for v in flipped:
+                bqm.flip_variable(v)
+
+            penalty_models.append((bqm, gap))
+
+        return penalty_models, misses
+
+    @staticmethod
+    def _within_bounds(bqm: dimod.BinaryQuadraticModel,
+                       flipped: Sequence[int],
+                       linear_bound: Tuple[float, float],
+                       quadratic_bound: Tuple[float, float],
+                       ) -> bool:
+        # whether the biases of an index-labelled bqm are within the bounds
+        # once the given variables are flipped
+        sign = np.ones(bqm.num_variables)
+        sign[list(flipped)] = -1
+        linear, (irow, icol, quadratic), _ = bqm.to_numpy_vectors(range(bqm.num_variables))
+        linear = linear * sign
+        quadratic = quadratic * sign[irow] * sign[icol]
+        return bool((linear_bound[0] <= linear).all() and (linear <= linear_bound[1]).all()
+                    and (quadratic_bound[0] <= quadratic).all()
+                    and (quadratic <= quadratic_bound[1]).all())
+
+    def _encode_query(self, samples_like, graph_like
+                      ) -> Tuple[bytes, Optional[Dict[Variable, int]], List[Variable]]:
+        # return the spec hash, the relabelling needed to get there if any,
+        # and the decision variables flipped to get there
         samples, labels = dimod.as_samples(samples_like)
+        energies = samples_like.record.energy if isinstance(samples_like, dimod.SampleSet) else None
         graph = as_graph(graph_like)
 
         # do some input checking
@@ -535,66 +1264,57 @@ class PenaltyModelCache(contextlib.AbstractContextManager):
             raise ValueError("graph_like's nodes must be a superset of the "
                              "samples_like's variables")
 
-        # we need the nodes/variables to be labelled [0, n). The variables
-        # also need to be sorted
-        if graph.nodes ^ range(len(graph.nodes)) or any(i != v for i, v in enumerate(labels)):
-            mapping = {v: i for i, v in enumerate(labels)}
-            mapping.update((v, i) for i, v in enumerate(graph.nodes ^ labels, len(mapping)))
-
-            bqm, gap = self.retrieve(samples, nx.relabel_nodes(graph, mapping, copy=True),
-                                     linear_bound=linear_bound,
-                                     quadratic_bound=quadratic_bound,
-                                     min_classical_gap=min_classical_gap)
-
-            inverse_mapping = dict((i, v) for v, i in mapping.items())
-            return bqm.relabel_variables(inverse_mapping, inplace=True), gap
+        mapping, graph, samples, energies, flipped = self._canonicalize(graph, samples, labels,
+                                                                        energies)
 
         parameters = self.encode_graph(graph)
-        parameters.update(self.encode_sampleset(samples_like))
-        parameters.update(
-            decision_variables=json.dumps(labels, separators=(',', ':')),
-            min_classical_gap=min_classical_gap,
-            min_linear_bias=linear_bound[0],
-            max_linear_bias=linear_bound[1],
-            min_quadratic_bias=quadratic_bound[0],
-            max_quadratic_bias=quadratic_bound[1],
-            )
+        parameters.update(self.encode_sampleset((samples, range(len(labels))), energies))
+        parameters.update(decision_variables=json.dumps(list(range(len(labels))),
+                                                        separators=(',', ':')))
 
-        cur = self.conn.cursor()
-        cur.execute(
-            """
-            SELECT bqm_data, classical_gap FROM penalty_model_view
-            WHERE
-                -- graph:
-                num_nodes = :num_nodes AND
-                num_edges = :num_edges AND
-                edges = :edges AND
-                -- feasible_configurations:
-                num_variables = :num_variables AND
-                samples = :samples AND
-                energies = :energies AND
-                -- decision variables:
-                decision_variables = :decision_variables AND
-                -- bounds
-                min_linear_bias >= :min_linear_bias AND
-                max_linear_bias <= :max_linear_bias AND
-                min_quadratic_bias >= :min_quadratic_bias AND
-                max_quadratic_bias <= :max_quadratic_bias AND
-                -- gap
-                classical_gap >= :min_classical_gap
-            ORDER BY classical_gap DESC;
-            """,
-            parameters
-            )
+        if all(v == i for v, i in mapping.items()):
+            mapping = None
+        return self.encode_spec(parameters), mapping, flipped
+
+    @staticmethod
+    def _canonicalize(graph: nx.Graph,
+                      samples: np.ndarray,
+                      labels: Sequence[Variable],
+                      energies: Optional[np.ndarray],
+                      ) -> Tuple[Dict[Variable, int], nx.Graph, np.ndarray, np.ndarray,
+                                 List[Variable]]:
+        # relabel a specification to [0, n) in its canonical form, returning
+        # the mapping, the relabelled graph, the flipped and reordered columns
+        # of samples, the energies and the decision variables that were flipped
+        index = {v: i for i, v in enumerate(labels)}
+        auxiliaries = [v for v in graph.nodes if v not in index]
+        index.update((v, i) for i, v in enumerate(auxiliaries, len(index)))
+
+        edges = tuple(sorted(tuple(sorted((index[u], index[v]))) for u, v in graph.edges))
+        table = np.ascontiguousarray(samples > 0)
+        if energies is None:
+            energies = np.zeros(len(table))
+        energies = np.asarray(energies, dtype='<f8')
+
+        form = canonical_form(len(index), edges, len(labels), table.tobytes(), energies.tobytes())
+        if form is None:
+            # too symmetric, so stick with the given order
+            order, flips = range(len(index)), [False] * len(labels)
+        else:
+            order, flips = form
+        table = table ^ np.asarray(flips, dtype=bool)
 
-        row = cur.fetchone()
-        cur.close()
+        position = [0] * len(index)
+        for i, v in enumerate(order):
+            position[v] = i
 
-        if row is None:
-            raise MissingPenaltyModel(
-                "no penalty model with the given specification found in cache")
+        canonical = nx.Graph()
+        canonical.add_nodes_from(range(len(index)))
+        canonical.add_edges_from((position[u], position[v]) for u, v in edges)
 
-        return self.decode_bqm(row), row['classical_gap']
+        mapping = {v: position[i] for v, i in index.items()}
+        flipped = [v for v, flip in zip(labels, flips) if flip]
+        return mapping, canonical, table[:, list(order[:len(labels)])], energies, flipped
 
 
 def patch_cache(database: Union[str, os.PathLike] = ':memory:'):
@@ -640,3 +1360,6 @@ def isolated_cache(*args, **kwargs):
                 yield
             finally:
                 PenaltyModelCache.database_path = current
+                PenaltyModelCache.close_shared_connections(
+                    os.path.join(d, PenaltyModelCache.database_name))
+                PenaltyModelCache.memory_cache.clear()
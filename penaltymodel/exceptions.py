@@ -28,3 +28,7 @@ class ImpossiblePenaltyModel(FactoryException):
 
 class MissingPenaltyModel(FactoryException):
     """PenaltyModel is missing from the cache or otherwise unavailable."""
+
+
+class GenerationTimeout(FactoryException):
+    """PenaltyModel generation ran out of time or was cancelled."""
@@ -14,18 +14,33 @@
 
 """The module is considered internal."""
 
-from collections import OrderedDict
-from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+import abc
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
+import threading
+import time
+
+from collections import OrderedDict, defaultdict
+from typing import (Callable, Dict, FrozenSet, Iterable, Iterator, List, Mapping, Optional,
+                    Sequence, Set, Tuple, Union)
 
 import dimod
 import networkx as nx
 import numpy as np
 import scipy.optimize
+import scipy.sparse
 
 from dimod.typing import GraphLike, Variable
 
-from penaltymodel.exceptions import ImpossiblePenaltyModel
-from penaltymodel.utils import as_graph
+from penaltymodel.exceptions import GenerationTimeout, ImpossiblePenaltyModel
+from penaltymodel.utils import as_graph, spin_reversals
+
+try:
+    import highspy
+except ImportError:  # pragma: no cover
+    highspy = None
 
 __all__ = []
 
@@ -94,25 +109,1196 @@ class Index:
         return range(2, 2 + self.num_variables())
 
 
-def all_possible(num_variables: int) -> np.ndarray:
-    """Create an array of all possible spin configurations."""
-    assert 0 <= num_variables < 1 << 8
-    a = np.unpackbits(np.arange(1 << num_variables, dtype=np.uint8).reshape(1 << num_variables, 1),
-                      axis=1, count=num_variables, bitorder='little').astype(np.int8)
+def spin_configurations(indices: np.ndarray, num_variables: int) -> np.ndarray:
+    """Create an array of the spin configurations encoded by the given indices.
+
+    The ``j``-th variable of the configuration is the ``j``-th bit of the
+    index, least significant first.
+    """
+    if not 0 <= num_variables < 64:
+        raise ValueError("num_variables must be between 0 and 63")
+    dtype = np.uint32 if num_variables <= 32 else np.uint64
+    bits = np.asarray(indices, dtype=dtype)[:, np.newaxis] >> np.arange(num_variables, dtype=dtype)
+    a = (bits & 1).astype(np.int8)
     a *= 2
     a -= 1
     return a
 
 
-def next_auxiliary(state: Tuple[int, ...]) -> Tuple[int, ...]:
-    s = list(state)
-    for i in range(len(s)-1, -1, -1):
-        if s[i] <= 0:
-            s[i] = 1
+def pack_states(states: np.ndarray) -> np.ndarray:
+    """Encode each spin configuration as an integer.
+
+    This is the inverse of :func:`spin_configurations`.
+    """
+    states = np.asarray(states)
+    if not states.shape[1] < 64:
+        raise ValueError("states must have fewer than 64 variables")
+    return (states > 0) @ (1 << np.arange(states.shape[1], dtype=np.int64))
+
+
+def iter_states(num_variables: int,
+                interactions: Iterable[Tuple[int, int]] = (),
+                *,
+                chunk_size: int = 1 << 16,
+                ) -> Iterator[np.ndarray]:
+    """Iterate over all possible spin configurations in fixed-size chunks.
+
+    Args:
+        num_variables: The number of variables.
+        interactions: Pairs of variable positions. The product of each pair
+            is appended as a column after the variables.
+        chunk_size: The maximum number of configurations in each chunk.
+
+    Yields:
+        Arrays of shape ``(chunk_size, num_variables + len(interactions))``,
+        in the order given by :func:`spin_configurations`. The last chunk may
+        be smaller.
+
+    """
+    interactions = np.asarray(list(interactions), dtype=int).reshape(-1, 2)
+    for start in range(0, 1 << num_variables, chunk_size):
+        stop = min(start + chunk_size, 1 << num_variables)
+        spins = spin_configurations(np.arange(start, stop), num_variables)
+        yield np.hstack((spins, spins[:, interactions[:, 0]] * spins[:, interactions[:, 1]]))
+
+
+def all_possible(num_variables: int) -> np.ndarray:
+    """Create an array of all possible spin configurations."""
+    return spin_configurations(np.arange(1 << num_variables), num_variables)
+
+
+@functools.lru_cache(maxsize=128)
+def topology_columns(num_variables: int, interactions: Tuple[Tuple[int, int], ...]) -> np.ndarray:
+    """Return the variable and interaction columns of every row of the LP matrix.
+
+    These depend only on the topology, not on the table, so they are cached
+    between calls. The returned array is read-only.
+    """
+    columns, = iter_states(num_variables, interactions, chunk_size=1 << num_variables)
+    columns.setflags(write=False)
+    return columns
+
+
+class StateMatrix:
+    """The constraint matrix of the LP, with one row per spin configuration.
+
+    Row ``i`` is the configuration given by :func:`spin_configurations`, with
+    the decision variables in the lowest bits. Rows are computed on demand so
+    the full matrix never needs to be held in memory.
+
+    Args:
+        indexer: The columns of the matrix.
+        interactions: The pair of variable positions of each interaction
+            column, in column order.
+        feasible: Whether each decision state, indexed the same way as the
+            rows, is in the table.
+        energies: The target energy of each decision state. For the
+            infeasible states, this is the highest feasible energy.
+
+    Problems with at most ``max_cached_variables`` variables share the
+    variable and interaction columns of their topology, see
+    :func:`topology_columns`.
+
+    """
+
+    chunk_size = 1 << 16
+
+    max_cached_variables = 12
+
+    def __init__(self,
+                 indexer: Index,
+                 interactions: Sequence[Tuple[int, int]],
+                 feasible: np.ndarray,
+                 energies: np.ndarray,
+                 ):
+        self.indexer = indexer
+        self.interactions = np.asarray(interactions, dtype=int).reshape(-1, 2)
+        self.feasible = feasible
+        self.energies = energies
+
+        self.num_decision = len(indexer.decisions())
+        self.num_variables = indexer.num_variables()
+        self.num_auxiliary = self.num_variables - self.num_decision
+
+        if self.num_variables <= self.max_cached_variables:
+            self.columns = topology_columns(self.num_variables,
+                                            tuple(map(tuple, self.interactions.tolist())))
+        else:
+            self.columns = None
+
+    def __len__(self) -> int:
+        return 1 << self.num_variables
+
+    @property
+    def num_columns(self) -> int:
+        return len(self.indexer)
+
+    def decision(self, indices: np.ndarray) -> np.ndarray:
+        """The index of the decision state of each row."""
+        return indices & ((1 << self.num_decision) - 1)
+
+    def row(self, decision: Union[int, np.ndarray], auxiliary: Union[int, np.ndarray]
+            ) -> Union[int, np.ndarray]:
+        """The row of the given decision and auxiliary states."""
+        return decision | (auxiliary << self.num_decision)
+
+    def variable_columns(self, indices: np.ndarray) -> np.ndarray:
+        """Return the variable and interaction columns of the given rows."""
+        if self.columns is not None:
+            return self.columns[indices]
+        spins = spin_configurations(indices, self.num_variables)
+        products = spins[:, self.interactions[:, 0]] * spins[:, self.interactions[:, 1]]
+        return np.hstack((spins, products))
+
+    def rows(self, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the rows of ``A`` and ``b`` for the given indices."""
+        indexer = self.indexer
+        decision = self.decision(indices)
+
+        A = np.empty((len(indices), len(indexer)), dtype=np.int8)
+        A[:, indexer.gap()] = self.feasible[decision] - 1  # 0 if feasible, -1 otherwise
+        A[:, indexer.offset()] = 1
+        A[:, indexer.variables().start:] = self.variable_columns(indices)
+
+        return A, self.energies[decision]
+
+    def sparse_rows(self, indices: np.ndarray, sign: int = 1
+                    ) -> Tuple[scipy.sparse.csr_matrix, np.ndarray]:
+        """Return the rows of ``sign * A`` and ``b`` for the given indices, in CSR format.
+
+        Every entry is +/-1 apart from the gap column of the feasible rows,
+        which is 0, so the nonzeros are laid out directly rather than searched
+        for in a dense matrix.
+        """
+        indexer = self.indexer
+        decision = self.decision(indices)
+        infeasible = ~self.feasible[decision].astype(bool)
+
+        num_columns = len(indexer)
+        data = np.empty((len(indices), num_columns))
+        data[:, indexer.gap()] = -1
+        data[:, indexer.offset()] = 1
+        data[:, indexer.variables().start:] = self.variable_columns(indices)
+        if sign != 1:
+            data *= sign
+
+        # drop the gap column of the feasible rows
+        mask = np.ones(data.shape, dtype=bool)
+        mask[:, indexer.gap()] = infeasible
+        columns = np.broadcast_to(np.arange(num_columns, dtype=np.int32), data.shape)
+
+        indptr = np.zeros(len(indices) + 1, dtype=np.int32)
+        np.cumsum(num_columns - 1 + infeasible, out=indptr[1:])
+
+        A = scipy.sparse.csr_matrix((data[mask], columns[mask], indptr), shape=data.shape)
+        return A, self.energies[decision]
+
+    def iter_rows(self, indices: Optional[np.ndarray] = None, *, sparse: bool = False
+                  ) -> Iterator[Tuple[np.ndarray, Union[np.ndarray, scipy.sparse.csr_matrix],
+                                      np.ndarray]]:
+        """Iterate over ``(indices, A, b)`` in chunks of at most ``chunk_size`` rows.
+
+        If ``indices`` is not given, iterate over all of the rows. If
+        ``sparse`` is true, ``A`` is given in CSR format, see
+        :meth:`sparse_rows`.
+        """
+        rows = self.sparse_rows if sparse else self.rows
+        if indices is None:
+            for start in range(0, len(self), self.chunk_size):
+                chunk = np.arange(start, min(start + self.chunk_size, len(self)))
+                yield (chunk, *rows(chunk))
+        else:
+            for start in range(0, len(indices), self.chunk_size):
+                chunk = indices[start:start + self.chunk_size]
+                yield (chunk, *rows(chunk))
+
+
+class Deadline:
+    """A time limit for generation, with an optional cancellation event.
+
+    Args:
+        timeout: The time limit in seconds from now. ``None`` for no limit.
+        cancel: Setting this event expires the deadline. It is not sent to
+            other processes, which only see the time limit. The workers of
+            :func:`parallel_backtrack` are stopped through an event of their
+            own.
+
+    """
+
+    def __init__(self, timeout: Optional[float] = None, cancel: Optional[threading.Event] = None):
+        self.stop = None if timeout is None else time.monotonic() + timeout
+        self.cancel = cancel
+
+    def __getstate__(self):
+        return dict(stop=self.stop, cancel=None)
+
+    def remaining(self) -> float:
+        """Return the number of seconds left."""
+        if self.stop is None:
+            return float('inf')
+        return max(self.stop - time.monotonic(), 0.)
+
+    def expired(self) -> bool:
+        return (self.cancel is not None and self.cancel.is_set()) or not self.remaining()
+
+    def check(self):
+        """Raise :exc:`GenerationTimeout` if the deadline has expired."""
+        if self.expired():
+            raise GenerationTimeout("ran out of time to generate a penalty model")
+
+
+class LinearProgram(abc.ABC):
+    """A feasibility linear program over the rows of a :class:`StateMatrix`.
+
+    Each row ``i`` encodes the inequality ``A[i, :] @ x >= b[i]``. Rows can be
+    fixed, in which case they encode the equality ``A[i, :] @ x == b[i]``
+    instead. The program is kept across the search so that consecutive solves,
+    which differ only by fixing or releasing a single row, do not have to
+    rebuild it.
+
+    If ``rows`` is given, only those rows are added to the program initially
+    and the remaining rows are added lazily, as cutting planes. Each time a
+    solution is found, the rows it violates are added, at most one per
+    decision state, and the program is re-solved. The initial rows should
+    include at least one row for each infeasible decision state, otherwise
+    the gap may appear to be unbounded.
+
+    Solving raises :exc:`GenerationTimeout` once ``deadline`` expires.
+    """
+
+    tolerance = 1e-9
+
+    def __init__(self,
+                 states: StateMatrix,
+                 bounds: Sequence[Tuple[Optional[float], Optional[float]]],
+                 rows: Optional[Iterable[int]] = None,
+                 deadline: Optional[Deadline] = None,
+                 ):
+        self.states = states
+        self.bounds = bounds
+        self.deadline = Deadline() if deadline is None else deadline
+
+        self.active = np.zeros(len(states), dtype=bool)
+
+        self.x: Optional[np.ndarray] = None  # the most recent solution
+
+        if rows is None:
+            for start in range(0, len(states), states.chunk_size):
+                self.add_rows(np.arange(start, min(start + states.chunk_size, len(states))))
+        else:
+            self.add_rows(np.fromiter(rows, dtype=int))
+
+    def add_rows(self, rows: np.ndarray):
+        """Add inequality rows to the program."""
+        rows = rows[~self.active[rows]]
+        self.active[rows] = True
+        self._add_rows(rows)
+
+    @abc.abstractmethod
+    def _add_rows(self, rows: np.ndarray):
+        pass
+
+    @abc.abstractmethod
+    def fix(self, i: int):
+        """Make row ``i`` an equality. The row must already be in the program."""
+        pass
+
+    @abc.abstractmethod
+    def release(self, i: int):
+        """Make row ``i`` an inequality."""
+        pass
+
+    def conflict(self) -> Optional[Set[int]]:
+        """Return the fixed rows involved in the most recent infeasible solve.
+
+        Returns ``None`` if the backend cannot tell, in which case all of the
+        fixed rows should be assumed to be involved.
+        """
+        return None
+
+    def _most_violated(self, indices: np.ndarray, residual: np.ndarray
+                       ) -> Tuple[np.ndarray, np.ndarray]:
+        violated = residual < -self.tolerance
+        indices = indices[violated]
+        residual = residual[violated]
+
+        order = np.argsort(residual, kind='stable')
+        _, first = np.unique(self.states.decision(indices[order]), return_index=True)
+        return indices[order[first]], residual[order[first]]
+
+    def separate(self) -> np.ndarray:
+        """Return the most violated missing row of each decision state, given ``x``."""
+        if self.active.all():
+            return np.empty(0, dtype=int)
+
+        candidates = []
+        residuals = []
+        chunk_size = self.states.chunk_size
+        for start in range(0, len(self.states), chunk_size):
+            indices = np.arange(start, min(start + chunk_size, len(self.states)))
+            indices = indices[~self.active[indices]]
+            A, b = self.states.rows(indices)
+            indices, residual = self._most_violated(indices, A @ self.x - b)
+            candidates.append(indices)
+            residuals.append(residual)
+
+        rows, _ = self._most_violated(np.concatenate(candidates), np.concatenate(residuals))
+        return rows
+
+    def residual(self, indices: np.ndarray) -> np.ndarray:
+        """Return ``A @ x - b`` for the given rows, given ``x``."""
+        residual = np.empty(len(indices))
+        for start in range(0, len(indices), self.states.chunk_size):
+            A, b = self.states.rows(indices[start:start + self.states.chunk_size])
+            residual[start:start + len(b)] = A @ self.x - b
+        return residual
+
+    def solve(self) -> bool:
+        """Return whether the program is feasible, storing the solution in ``x``."""
+        self.deadline.check()
+        while self._solve():
+            self.deadline.check()
+            rows = self.separate()
+            if not len(rows):
+                return True
+            self.add_rows(rows)
+        return False
+
+    @abc.abstractmethod
+    def _solve(self) -> bool:
+        pass
+
+    def maximize_gap(self) -> Optional[float]:
+        """Maximize the gap, storing the solution in ``x``.
+
+        Returns ``None`` if the program is infeasible. If the gap is unbounded
+        then ``x`` is left unchanged.
+        """
+        while True:
+            self.deadline.check()
+            gap = self._maximize_gap()
+            if gap is None or gap == float('inf'):
+                return gap
+            rows = self.separate()
+            if not len(rows):
+                # the solver can leave the gap a rounding error below its
+                # lower bound, which is the minimum gap asked for
+                lower, _ = self.bounds[Index.gap()]
+                return gap if lower is None else max(gap, lower)
+            self.add_rows(rows)
+
+    @abc.abstractmethod
+    def _maximize_gap(self) -> Optional[float]:
+        pass
+
+    def gap(self) -> float:
+        """Return the classical gap of ``x``, over all of the rows.
+
+        This can be larger than the gap column of ``x`` when the gap has not
+        been maximized.
+        """
+        infeasible = np.flatnonzero(~self.states.feasible.astype(bool))
+        if not len(infeasible):
+            return float('inf')
+
+        # the gap column contributes -x[gap] to each infeasible row
+        auxiliary_states = np.arange(1 << self.states.num_auxiliary)
+        rows = self.states.row(infeasible[:, np.newaxis], auxiliary_states).ravel()
+        return self.residual(rows).min() + self.x[Index.gap()]
+
+
+class HighsLinearProgram(LinearProgram):
+    """A linear program kept alive in a single HiGHS model.
+
+    Fixing and releasing rows changes their bounds in place, so each solve
+    is warm-started from the basis of the previous one with the dual simplex.
+    """
+
+    def __init__(self, states, bounds, rows=None, deadline=None):
+        inf = highspy.kHighsInf
+
+        self.model = model = highspy.Highs()
+        model.silent()
+        model.setOptionValue('presolve', 'off')  # presolve discards the basis
+        model.setOptionValue('solver', 'simplex')
+        model.setOptionValue('simplex_strategy', 1)  # dual
+
+        num_cols = states.num_columns
+        lower = np.array([-inf if lb is None else lb for lb, _ in bounds], dtype=float)
+        upper = np.array([inf if ub is None else ub for _, ub in bounds], dtype=float)
+        model.addCols(num_cols, np.zeros(num_cols), lower, upper,
+                      0, np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0))
+
+        # the position of each row of the state matrix in the model
+        self.position: Dict[int, int] = {}
+
+        # the target energy of each row in the model
+        self.b: Dict[int, float] = {}
+
+        self.fixed: Set[int] = set()
+
+        super().__init__(states, bounds, rows, deadline)
+
+    def _add_rows(self, rows):
+        for indices, A, b in self.states.iter_rows(rows, sparse=True):
+            if not len(indices):
+                continue
+
+            self.position.update(zip(indices.tolist(), itertools.count(self.model.getNumRow())))
+            self.b.update(zip(indices.tolist(), b.tolist()))
+
+            self.model.addRows(len(indices), b.astype(float),
+                               np.full(len(indices), highspy.kHighsInf),
+                               A.nnz, A.indptr[:-1], A.indices, A.data)
+
+    def fix(self, i):
+        self.model.changeRowBounds(self.position[i], self.b[i], self.b[i])
+        self.fixed.add(i)
+
+    def release(self, i):
+        self.model.changeRowBounds(self.position[i], self.b[i], highspy.kHighsInf)
+        self.fixed.discard(i)
+
+    def conflict(self):
+        # the fixed rows with a nonzero multiplier in the Farkas certificate
+        _, has_dual_ray, dual_ray = self.model.getDualRay()
+        if not has_dual_ray:
+            return None
+        return set(i for i in self.fixed if abs(dual_ray[self.position[i]]) > self.tolerance)
+
+    def _run(self) -> 'highspy.HighsModelStatus':
+        self.model.setOptionValue('time_limit', min(self.deadline.remaining(), highspy.kHighsInf))
+        self.model.run()
+        status = self.model.getModelStatus()
+        if status == highspy.HighsModelStatus.kOptimal:
+            self.x = np.asarray(self.model.getSolution().col_value)
+        elif status == highspy.HighsModelStatus.kTimeLimit:
+            raise GenerationTimeout("ran out of time to generate a penalty model")
+        return status
+
+    def _solve(self):
+        return self._run() == highspy.HighsModelStatus.kOptimal
+
+    def _maximize_gap(self):
+        self.model.changeColCost(Index.gap(), -1)
+        try:
+            status = self._run()
+        finally:
+            self.model.changeColCost(Index.gap(), 0)
+
+        if status == highspy.HighsModelStatus.kOptimal:
+            return self.x[Index.gap()]
+        elif status == highspy.HighsModelStatus.kUnbounded:
+            # can happen for a fully specified problem
+            return float('inf')
+        elif status == highspy.HighsModelStatus.kInfeasible:
+            return None
+        elif status == highspy.HighsModelStatus.kUnboundedOrInfeasible:
+            return float('inf') if self._solve() else None
+        else:
+            raise RuntimeError("something went wrong")
+
+
+class ScipyLinearProgram(LinearProgram):
+    """A linear program solved from scratch with :func:`scipy.optimize.linprog`.
+
+    Used when :mod:`highspy` is not installed.
+    """
+
+    def __init__(self, states, bounds, rows=None, deadline=None):
+        self.upper_bound: List[int] = []
+        self.equality: List[int] = []
+
+        super().__init__(states, bounds, rows, deadline)
+
+    def _add_rows(self, rows):
+        self.upper_bound.extend(rows.tolist())
+
+    def fix(self, i):
+        self.upper_bound.remove(i)
+        self.equality.append(i)
+
+    def release(self, i):
+        self.equality.remove(i)
+        self.upper_bound.append(i)
+
+    def _linprog(self, c: np.ndarray) -> scipy.optimize.OptimizeResult:
+        A_eq, b_eq = self.states.sparse_rows(np.asarray(self.equality, dtype=int))
+        # negate because we want A_ub <= b_ub
+        A_ub, b_ub = self.states.sparse_rows(np.asarray(self.upper_bound, dtype=int), sign=-1)
+
+        options = {}
+        if self.deadline.stop is not None:
+            options.update(time_limit=self.deadline.remaining())
+
+        res = scipy.optimize.linprog(c, A_ub, -b_ub, A_eq, b_eq, bounds=self.bounds, method='highs',
+                                     options=options)
+        if res.status == 1:
+            # error code 1 is the iteration or time limit
+            raise GenerationTimeout("ran out of time to generate a penalty model")
+        return res
+
+    def _solve(self):
+        res = self._linprog(np.zeros(self.states.num_columns))
+        if res.success:
+            self.x = res.x
+        return res.success
+
+    def _maximize_gap(self):
+        c = np.zeros(self.states.num_columns)
+        c[Index.gap()] = -1
+        res = self._linprog(c)
+        if res.success:
+            self.x = res.x
+            return self.x[Index.gap()]
+        elif res.status == 3:
+            # error code 3 is unbounded objective, which can happen for a fully
+            # specified problem
+            return float('inf')
+        elif res.status == 2:
+            return None
+        else:
+            raise RuntimeError("something went wrong")
+
+
+def linear_program(states: StateMatrix,
+                   bounds: Sequence[Tuple[Optional[float], Optional[float]]],
+                   rows: Optional[Iterable[int]] = None,
+                   deadline: Optional[Deadline] = None,
+                   ) -> LinearProgram:
+    """Create a linear program using the best available backend."""
+    if highspy is not None:
+        return HighsLinearProgram(states, bounds, rows, deadline)
+    return ScipyLinearProgram(states, bounds, rows, deadline)
+
+
+def auxiliary_domains(graph: nx.Graph,
+                      decision: Sequence[Variable],
+                      auxiliaries: Sequence[Variable],
+                      *,
+                      gauge: bool,
+                      max_automorphisms: int = 1000,
+                      ) -> List[List[int]]:
+    """Restrict the auxiliary states of the first decision states to break symmetry.
+
+    If ``gauge`` is true, flipping an auxiliary variable and negating its
+    biases gives another penalty model, so WLOG the first decision state has
+    every auxiliary variable at -1.
+
+    Automorphisms of ``graph`` that fix every decision variable permute the
+    auxiliary variables. So WLOG the next decision state has an auxiliary
+    state no greater than its image under each of them. At most
+    ``max_automorphisms`` are used. The automorphisms depend only on the
+    topology, so they are cached between calls, see
+    :func:`automorphism_domain`.
+
+    Returns:
+        The auxiliary states to try for each of the first decision states,
+        see :func:`backtrack`.
+
+    """
+    num_auxiliary = len(auxiliaries)
+
+    domains: List[List[int]] = []
+    if not num_auxiliary:
+        return domains
+
+    if gauge:
+        domains.append([0])
+
+    # only look for automorphisms if we can afford to enumerate the auxiliary states
+    if 1 << num_auxiliary > StateMatrix.chunk_size:
+        return domains
+
+    position = dict((v, i) for i, v in enumerate(itertools.chain(decision, auxiliaries)))
+    edges = tuple(sorted(tuple(sorted((position[u], position[v]))) for u, v in graph.edges))
+
+    domain = automorphism_domain(len(decision), num_auxiliary, edges, max_automorphisms)
+    if domain is not None:
+        domains.append(list(domain))
+    return domains
+
+
+@functools.lru_cache(maxsize=128)
+def automorphism_domain(num_decision: int,
+                        num_auxiliary: int,
+                        edges: Tuple[Tuple[int, int], ...],
+                        max_automorphisms: int = 1000,
+                        ) -> Optional[Tuple[int, ...]]:
+    """Return the auxiliary states that are lex-leaders under the automorphisms of a graph.
+
+    The nodes of the graph are ``range(num_decision + num_auxiliary)``, with
+    the decision variables first, and the automorphisms must fix every
+    decision variable. See :func:`auxiliary_domains`.
+
+    Returns ``None`` if every auxiliary state is a lex-leader.
+    """
+    # the decision variables can only be mapped to themselves
+    labelled = nx.Graph()
+    labelled.add_nodes_from((v, dict(label=v if v < num_decision else None))
+                            for v in range(num_decision + num_auxiliary))
+    labelled.add_edges_from(edges)
+
+    matcher = nx.algorithms.isomorphism.GraphMatcher(
+        labelled, labelled, node_match=lambda a, b: a['label'] == b['label'])
+
+    auxiliaries = range(num_decision, num_decision + num_auxiliary)
+    identity = list(range(num_auxiliary))
+
+    auxiliary_states = np.arange(1 << num_auxiliary)
+    spins = spin_configurations(auxiliary_states, num_auxiliary)
+    canonical = np.ones(len(auxiliary_states), dtype=bool)
+    for mapping in itertools.islice(matcher.isomorphisms_iter(), max_automorphisms):
+        permutation = [mapping[v] - num_decision for v in auxiliaries]
+        if permutation != identity:
+            canonical &= auxiliary_states <= pack_states(spins[:, np.argsort(permutation)])
+
+    if canonical.all():
+        return None
+    return tuple(np.flatnonzero(canonical).tolist())
+
+
+VariableOrder = Callable[[LinearProgram, StateMatrix, Sequence[int]], int]
+ValueOrder = Callable[[LinearProgram, StateMatrix, int, Sequence[int]], Sequence[int]]
+
+
+def static_variable_order(lp: LinearProgram, states: StateMatrix, candidates: Sequence[int]) -> int:
+    """Fix the decision states in the order given."""
+    return candidates[0]
+
+
+def tightest_variable_order(lp: LinearProgram,
+                            states: StateMatrix,
+                            candidates: Sequence[int],
+                            ) -> int:
+    """Fix the decision state with an auxiliary state that has the least slack.
+
+    That is, the one that the current solution is closest to giving a ground
+    state, so fixing it disturbs the solution the least.
+    """
+    auxiliary_states = np.arange(1 << states.num_auxiliary)
+    rows = states.row(np.asarray(candidates)[:, np.newaxis], auxiliary_states).ravel()
+    slack = lp.residual(rows).reshape(len(candidates), len(auxiliary_states)).min(axis=1)
+    return candidates[int(np.argmin(slack))]
+
+
+def static_value_order(lp: LinearProgram, states: StateMatrix, decision_state: int,
+                       domain: Sequence[int]) -> Sequence[int]:
+    """Try the auxiliary states in the order given."""
+    return domain
+
+
+def relaxation_value_order(lp: LinearProgram, states: StateMatrix, decision_state: int,
+                           domain: Sequence[int]) -> Sequence[int]:
+    """Try the auxiliary states that are closest to being ground states first."""
+    domain = np.asarray(domain, dtype=int)
+    slack = lp.residual(states.row(decision_state, domain))
+    return domain[np.argsort(slack, kind='stable')].tolist()
+
+
+VARIABLE_ORDERS: Dict[str, VariableOrder] = dict(static=static_variable_order,
+                                                 tightest=tightest_variable_order)
+VALUE_ORDERS: Dict[str, ValueOrder] = dict(static=static_value_order,
+                                           relaxation=relaxation_value_order)
+
+
+def backtrack(lp: LinearProgram,
+              states: StateMatrix,
+              ground: Sequence[int],
+              domains: Sequence[Sequence[int]] = (),
+              *,
+              variable_order: VariableOrder = static_variable_order,
+              value_order: ValueOrder = static_value_order,
+              ) -> Dict[int, int]:
+    """Find a feasible auxiliary state for each decision state by backtracking.
+
+    When a linear program is infeasible, the search asks it which fixed rows
+    are involved. That set is recorded as a nogood, so the same combination
+    is never tried again, and once every auxiliary state of a decision state
+    has failed the search jumps straight back to the deepest decision state
+    involved in any of those failures, rather than to the previous one.
+
+    Args:
+        lp: The linear program, with no rows fixed.
+        states: The LP matrix.
+        ground: The feasible decision states.
+        domains: The auxiliary states to try for the first ``len(domains)``
+            decision states fixed. The remaining decision states try every
+            auxiliary state.
+        variable_order: Picks the next decision state to fix from the ones
+            not yet fixed, given the current solution of ``lp``.
+        value_order: Orders the auxiliary states to try for a decision state,
+            given the current solution of ``lp``.
+
+    Returns:
+        A dict mapping each decision state to its auxiliary state, in the
+        order they were fixed. ``lp`` is left feasible, with the
+        corresponding rows fixed.
+
+    Raises:
+        ImpossiblePenaltyModel: If no feasible assignment exists.
+
+    """
+    num_auxiliary_states = 1 << states.num_auxiliary
+
+    # the decision state fixed at each depth, its auxiliary states in the
+    # order they are tried, and the position of the current one
+    order: List[int] = []
+    values: List[Sequence[int]] = []
+    choices: List[int] = []
+
+    # the depth of each fixed decision state
+    position: Dict[int, int] = {}
+
+    # for each depth, the shallower depths involved in ruling out its
+    # auxiliary states so far
+    conflicts: List[Set[int]] = []
+
+    # the learned nogoods, as sets of (decision state, auxiliary state) pairs,
+    # indexed by each of their pairs
+    nogoods: Dict[Tuple[int, int], List[FrozenSet[Tuple[int, int]]]] = defaultdict(list)
+
+    def current(depth: int) -> Tuple[int, int]:
+        return order[depth], values[depth][choices[depth]]
+
+    def learn(depths: Iterable[int]):
+        nogood = frozenset(map(current, depths))
+        for pair in nogood:
+            nogoods[pair].append(nogood)
+
+    def known_conflict(depth: int) -> Optional[Set[int]]:
+        # we only need to check the nogoods involving the newest pair, the
+        # others would have been caught at a shallower depth
+        for nogood in nogoods[current(depth)]:
+            depths = set()
+            for decision_state, auxiliary_state in nogood:
+                d = position.get(decision_state)
+                if d is None or current(d)[1] != auxiliary_state:
+                    break
+                depths.add(d)
+            else:
+                return depths
+        return None
+
+    def push():
+        depth = len(order)
+        if depth and len(ground) - depth > 1:
+            decision_state = variable_order(lp, states, [s for s in ground if s not in position])
+        else:
+            decision_state = next(s for s in ground if s not in position)
+        domain = domains[depth] if depth < len(domains) else range(num_auxiliary_states)
+        if depth:
+            domain = value_order(lp, states, decision_state, domain)
+
+        order.append(decision_state)
+        values.append(domain)
+        choices.append(0)
+        position[decision_state] = depth
+        conflicts.append(set())
+        lp.fix(states.row(*current(depth)))
+
+    def pop():
+        lp.release(states.row(*current(len(order) - 1)))  # put it back into inequality
+        del position[order.pop()]
+        values.pop()
+        choices.pop()
+
+    push()
+
+    while True:
+        depth = len(order) - 1
+
+        conflict = known_conflict(depth)
+        if conflict is None:
+            if lp.solve():
+                if len(order) == len(ground):
+                    return OrderedDict(map(current, range(len(order))))
+
+                # fix a new state
+                push()
+                continue
+
+            rows = lp.conflict()
+            if rows is None:
+                # no certificate, so assume that every fixed row is involved
+                conflict = set(range(depth + 1))
+            else:
+                conflict = set(d for d in range(depth + 1) if states.row(*current(d)) in rows)
+                conflict.add(depth)  # it was feasible before we fixed this one
+            learn(conflict)
+
+        conflicts[depth].update(conflict)
+        conflicts[depth].discard(depth)
+
+        # ok, we didn't succeed. Jump back to the deepest decision state that
+        # still has an auxiliary state to try and that was involved in ruling
+        # out the ones in between
+        while choices[depth] == len(values[depth]) - 1:
+            jump = conflicts.pop()
+            if not jump:
+                raise ImpossiblePenaltyModel("There is no BQM that can encode the given constraint")
+
+            # every auxiliary state is ruled out by this combination
+            learn(jump)
+
+            target = max(jump)
+            while depth > target:
+                pop()
+                depth -= 1
+                if depth > target:
+                    conflicts.pop()
+
+            conflicts[depth].update(jump)
+            conflicts[depth].discard(depth)
+
+        # iterate the auxiliary state
+        lp.release(states.row(*current(depth)))
+        choices[depth] += 1
+        lp.fix(states.row(*current(depth)))
+
+
+# set in the worker processes of parallel_backtrack, to stop their subtrees
+_worker_cancel: Optional[threading.Event] = None
+
+
+def _init_worker(cancel):
+    global _worker_cancel
+    _worker_cancel = cancel
+
+
+def backtrack_subtree(states: StateMatrix,
+                      bounds: Sequence[Tuple[Optional[float], Optional[float]]],
+                      rows: Optional[np.ndarray],
+                      ground: Sequence[int],
+                      prefix: Sequence[int],
+                      domains: Sequence[Sequence[int]] = (),
+                      deadline: Optional[Deadline] = None,
+                      **kwargs,
+                      ) -> Dict[int, int]:
+    """Run :func:`backtrack` with the first decision states fixed.
+
+    ``prefix`` gives the auxiliary states of the first ``len(prefix)``
+    decision states in ``ground``, and ``domains`` and the keyword arguments
+    are as for :func:`backtrack`. This builds its own linear program so it can be run in
+    a separate process.
+    """
+    if _worker_cancel is not None:
+        # in a worker of parallel_backtrack, so also stop when it says so
+        if deadline is None:
+            deadline = Deadline()
+        deadline.cancel = _worker_cancel
+
+    lp = linear_program(states, bounds, rows, deadline)
+
+    for decision_state, auxiliary_state in zip(ground, prefix):
+        lp.fix(states.row(decision_state, auxiliary_state))
+    if not lp.solve():
+        raise ImpossiblePenaltyModel("There is no BQM that can encode the given constraint")
+
+    auxiliary_configurations: Dict[int, int] = OrderedDict(zip(ground, prefix))
+    if len(prefix) < len(ground):
+        auxiliary_configurations.update(
+            backtrack(lp, states, ground[len(prefix):], domains[len(prefix):], **kwargs))
+    return auxiliary_configurations
+
+
+def parallel_backtrack(states: StateMatrix,
+                       bounds: Sequence[Tuple[Optional[float], Optional[float]]],
+                       rows: Optional[np.ndarray],
+                       ground: Sequence[int],
+                       *,
+                       workers: int,
+                       split_depth: int = 1,
+                       domains: Sequence[Sequence[int]] = (),
+                       deadline: Optional[Deadline] = None,
+                       **kwargs,
+                       ) -> Dict[int, int]:
+    """Find a feasible auxiliary state for each decision state in parallel.
+
+    The search tree is split on the auxiliary states of the first
+    ``split_depth`` decision states that have more than one allowed, and the
+    subtrees are searched with :func:`backtrack_subtree` in a process pool,
+    with ``domains`` and the keyword arguments as for :func:`backtrack`. The assignment of the first
+    subtree, in search order, that has one is returned and the other
+    subtrees are cancelled.
+
+    Raises:
+        ImpossiblePenaltyModel: If every subtree is exhausted.
+        GenerationTimeout: If ``deadline`` expires first.
+
+    """
+    if deadline is None:
+        deadline = Deadline()
+
+    # decision states with a single allowed auxiliary state don't split the
+    # tree, so they go into every prefix without counting towards the depth
+    prefix_domains = []
+    for depth in range(len(ground)):
+        if split_depth <= 0:
             break
+        domain = domains[depth] if depth < len(domains) else range(1 << states.num_auxiliary)
+        prefix_domains.append(domain)
+        if len(domain) > 1:
+            split_depth -= 1
+    prefixes = itertools.product(*prefix_domains)
+
+    # the subtrees that are already running are stopped through this event
+    context = multiprocessing.get_context()
+    cancel = context.Event()
+
+    executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context,
+                                                      initializer=_init_worker,
+                                                      initargs=(cancel,))
+    try:
+        futures = [executor.submit(backtrack_subtree, states, bounds, rows, ground, prefix, domains,
+                                   deadline, **kwargs)
+                   for prefix in prefixes]
+
+        # take the results in order, so we find the same assignment as the
+        # sequential search
+        for future in futures:
+            while not future.done():
+                deadline.check()
+                concurrent.futures.wait([future], timeout=min(deadline.remaining(), .1))
+            try:
+                return future.result()
+            except ImpossiblePenaltyModel:
+                pass  # this subtree is exhausted
+    finally:
+        # stop the subtrees that are running and wait for them to do so, which
+        # they do at their next solve, so no processes are left behind
+        cancel.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    raise ImpossiblePenaltyModel("There is no BQM that can encode the given constraint")
+
+
+def milp(states: StateMatrix,
+         ground: np.ndarray,
+         bounds: Sequence[Tuple[Optional[float], Optional[float]]],
+         domains: Sequence[Sequence[int]] = (),
+         deadline: Optional[Deadline] = None,
+         ) -> Dict[int, int]:
+    """Find a feasible auxiliary state for each decision state with a single MILP.
+
+    Each pair of feasible decision state ``s`` and auxiliary state ``a`` gets a
+    binary indicator ``z[s, a]``, exactly one of which is set for each ``s``.
+    Every row satisfies ``A[r, :] @ x >= b[r]`` and the rows of the chosen
+    pairs are made tight with the big-M constraint
+    ``A[r, :] @ x - b[r] <= M * (1 - z[s, a])``. The gap is maximized over
+    all of the assignments.
+
+    There are ``2**num_auxiliary`` indicators per feasible decision state, so
+    this is best suited to problems with few auxiliary variables.
+
+    If ``deadline`` expires during the solve, the best assignment found so
+    far is returned.
+
+    Args:
+        states: The LP matrix.
+        ground: The feasible decision states.
+        bounds: The bounds on the LP columns.
+        domains: The allowed auxiliary states for each of the first
+            ``len(domains)`` decision states, see :func:`backtrack`.
+
+    Returns:
+        A dict mapping each decision state to its auxiliary state.
+
+    Raises:
+        ImpossiblePenaltyModel: If no feasible assignment exists.
+        GenerationTimeout: If ``deadline`` expires before an assignment is
+            found.
+
+    """
+    try:
+        from scipy.optimize import milp, Bounds, LinearConstraint
+    except ImportError:  # pragma: no cover
+        raise RuntimeError("method='milp' requires scipy>=1.9") from None
+
+    num_columns = states.num_columns
+    num_auxiliary_states = 1 << states.num_auxiliary
+
+    # the energy of two states sharing a decision state differ by at most the
+    # contribution of the terms involving the auxiliary variables
+    variables = states.indexer.variables()
+    linear = max(map(abs, bounds[variables.start]))
+    quadratic = max(map(abs, bounds[variables.stop])) if len(states.interactions) else 0
+    M = 2 * (states.num_auxiliary * linear
+             + (states.interactions >= states.num_decision).any(axis=1).sum() * quadratic)
+
+    # every row is an inequality
+    chunks = [(A, b) for _, A, b in states.iter_rows(sparse=True)]
+    A_all = scipy.sparse.vstack([A for A, _ in chunks])
+    b_all = np.concatenate([b for _, b in chunks])
+
+    # the pairs that the domains allow. The others don't get an indicator at
+    # all, fixing them to zero by their bounds can trip up the solver
+    allowed = np.ones((len(ground), num_auxiliary_states), dtype=bool)
+    for depth, domain in enumerate(domains[:len(ground)]):
+        allowed[depth] = False
+        allowed[depth, domain] = True
+    pairs = np.flatnonzero(allowed)
+    num_indicators = len(pairs)
+
+    # the feasible rows, in the same order as the indicators
+    rows = states.row(ground[:, np.newaxis], np.arange(num_auxiliary_states)).ravel()[pairs]
+    A_feasible, b_feasible = states.sparse_rows(rows)
+
+    # exactly one auxiliary state per decision state
+    one_hot = scipy.sparse.csr_matrix((np.ones(num_indicators),
+                                       (pairs // num_auxiliary_states, np.arange(num_indicators))),
+                                      shape=(len(ground), num_indicators))
+
+    A = scipy.sparse.vstack([
+        scipy.sparse.hstack([A_all, scipy.sparse.csr_matrix((A_all.shape[0], num_indicators))]),
+        scipy.sparse.hstack([A_feasible, M * scipy.sparse.eye(num_indicators)]),
+        scipy.sparse.hstack([scipy.sparse.csr_matrix((len(ground), num_columns)), one_hot]),
+        ], format='csr')
+    lower = np.concatenate([b_all, np.full(num_indicators, -np.inf), np.ones(len(ground))])
+    upper = np.concatenate([np.full(A_all.shape[0], np.inf), b_feasible + M, np.ones(len(ground))])
+
+    lb = [-np.inf if lo is None else lo for lo, _ in bounds] + [0] * num_indicators
+    ub = [np.inf if hi is None else hi for _, hi in bounds] + [1] * num_indicators
+    integrality = np.concatenate([np.zeros(num_columns), np.ones(num_indicators)])
+
+    # maximize the gap, unless every decision state is feasible in which case
+    # it is unbounded
+    c = np.zeros(num_columns + num_indicators)
+    if not states.feasible.all():
+        c[Index.gap()] = -1
+
+    options = {}
+    if deadline is not None:
+        deadline.check()
+        if deadline.stop is not None:
+            options.update(time_limit=deadline.remaining())
+
+    res = milp(c,
+               constraints=LinearConstraint(A, lower, upper),
+               integrality=integrality,
+               bounds=Bounds(lb, ub),
+               options=options,
+               )
+
+    if res.status == 4:
+        # HiGHS' presolve can fail on models where the domains leave a single
+        # indicator for a decision state, so try again without it
+        if deadline is not None:
+            deadline.check()
+            if deadline.stop is not None:
+                options.update(time_limit=deadline.remaining())
+        res = milp(c,
+                   constraints=LinearConstraint(A, lower, upper),
+                   integrality=integrality,
+                   bounds=Bounds(lb, ub),
+                   options=dict(options, presolve=False),
+                   )
+
+    if res.status == 2:
+        raise ImpossiblePenaltyModel("There is no BQM that can encode the given constraint")
+    elif res.status == 1 and res.x is None:
+        # error code 1 is the iteration or time limit
+        raise GenerationTimeout("ran out of time to generate a penalty model")
+    elif res.x is None:
+        raise RuntimeError("something went wrong")
+
+    indicators = np.zeros(len(ground) * num_auxiliary_states)
+    indicators[pairs] = res.x[num_columns:]
+    indicators = indicators.reshape(len(ground), num_auxiliary_states)
+    return OrderedDict(zip(ground.tolist(), indicators.argmax(axis=1).tolist()))
+
+
+def split_table(graph: nx.Graph,
+                decision: Sequence[Variable],
+                samples: np.ndarray,
+                energies: np.ndarray,
+                ) -> Optional[List[Tuple[nx.Graph, List[Variable], np.ndarray]]]:
+    """Split the problem over the connected components of the graph.
+
+    A penalty model for the whole graph is the sum of independent penalty
+    models for its components, provided that the table is the product of its
+    projections onto the components. The energies of the components are
+    only additive in general if the feasible states all share one energy,
+    so other tables are not split.
+
+    Returns:
+        ``None`` if the problem cannot be split. Otherwise the subgraph, the
+        decision variables and the projected table of each component.
+
+    """
+    components = list(nx.connected_components(graph))
+    if len(components) < 2 or (energies != energies[0]).any():
+        return None
+
+    position = dict((v, i) for i, v in enumerate(decision))
+
+    blocks = []
+    size = 1
+    for component in components:
+        columns = [position[v] for v in decision if v in component]
+        if columns:
+            projected = np.unique(samples[:, columns], axis=0)
+            size *= len(projected)
         else:
-            s[i] = -1
-    return tuple(s)
+            projected = np.empty((0, 0), dtype=samples.dtype)
+        blocks.append((graph.subgraph(component), [decision[c] for c in columns], projected))
+
+    if size != len(np.unique(pack_states(samples))):
+        return None
+    return blocks
+
+
+def generate_blocks(blocks: Sequence[Tuple[nx.Graph, List[Variable], np.ndarray]],
+                    decision: Sequence[Variable],
+                    samples: np.ndarray,
+                    energy: float,
+                    deadline: Deadline,
+                    **kwargs,
+                    ) -> Tuple[dimod.BinaryQuadraticModel, float,
+                               Dict[Tuple[int, ...], Tuple[int, ...]]]:
+    """Generate a penalty model as the sum of one per block of :func:`split_table`.
+
+    ``samples`` are the feasible states, as spins, which all have the given
+    ``energy``. The keyword arguments are passed to :func:`generate`, along
+    with whatever is left of ``deadline``.
+    """
+    bqm = dimod.BinaryQuadraticModel('SPIN')
+    gap = float('inf')
+
+    # the auxiliary configurations of each block, by its decision variables
+    block_configurations = []
+    for subgraph, block_decision, block_samples in blocks:
+        if not block_decision:
+            # nothing to constrain, every state is a ground state
+            bqm.add_linear_from((v, 0) for v in subgraph.nodes)
+            bqm.add_quadratic_from((u, v, 0) for u, v in subgraph.edges)
+            block_configurations.append((block_decision,
+                                         {(): dict((v, -1) for v in subgraph.nodes)}))
+            continue
+
+        # the first block with decision variables carries the energy
+        sampleset = dimod.SampleSet.from_samples((block_samples, block_decision), vartype='SPIN',
+                                                 energy=np.full(len(block_samples), energy))
+        energy = 0
+
+        timeout = None if deadline.stop is None else deadline.remaining()
+        block_bqm, block_gap, block_aux = generate(subgraph, sampleset, decompose=False,
+                                                   timeout=timeout, cancel=deadline.cancel,
+                                                   **kwargs)
+
+        bqm.update(block_bqm)
+        gap = min(gap, block_gap)
+        block_configurations.append((block_decision, block_aux))
+
+    position = dict((v, i) for i, v in enumerate(decision))
+
+    aux = {}
+    for state in np.unique(samples, axis=0).tolist():
+        aux[tuple(state)] = configuration = {}
+        for block_decision, block_aux in block_configurations:
+            configuration.update(block_aux[tuple(state[position[v]] for v in block_decision)])
+
+    return bqm, gap, aux
 
 
 def generate(graph_like: GraphLike,
@@ -121,12 +1307,114 @@ def generate(graph_like: GraphLike,
              linear_bound: Tuple[float, float] = (-2, 2),
              quadratic_bound: Tuple[float, float] = (-1, 1),
              min_classical_gap: float = 2,
+             cutting_planes: bool = False,
+             method: str = 'backtrack',
+             workers: int = 1,
+             split_depth: int = 1,
+             symmetry_breaking: bool = True,
+             variable_order: Union[str, VariableOrder] = 'static',
+             value_order: Union[str, ValueOrder] = 'relaxation',
+             decompose: bool = True,
+             target_gap: Optional[float] = None,
+             timeout: Optional[float] = None,
+             cancel: Optional[threading.Event] = None,
              ) -> Tuple[dimod.BinaryQuadraticModel, float, Dict[Tuple[int, ...], Tuple[int, ...]]]:
     """Generate a penalty model.
 
     This function is considered internal, it is recommended to use
     :func:`~penaltymodel.get_penalty_model` with ``use_cache=False`` instead.
+
+    See :func:`~penaltymodel.get_penalty_model` for a description of the
+    shared arguments.
+
+    Args:
+        cutting_planes:
+            If ``True``, the linear programs start from only the feasible
+            states and one state per infeasible decision state. The
+            remaining states are added as they are found to be violated.
+            This can considerably reduce the size of each linear program
+            for larger graphs.
+
+        method:
+            How to find the ground states of the auxiliary variables.
+            ``'backtrack'`` searches over the auxiliary states of each feasible
+            decision state, solving a linear program at each step.
+            ``'milp'`` encodes the choice as binary variables and solves a
+            single mixed-integer linear program, which is typically much
+            faster at proving that no penalty model exists. Requires
+            SciPy 1.9 or later.
+
+        workers:
+            The number of processes used by ``method='backtrack'``. If greater
+            than one, the search is split into independent subtrees that are
+            searched in a process pool.
+
+        split_depth:
+            The number of feasible decision states whose auxiliary states
+            are enumerated to split the search when ``workers`` is greater
+            than one. Decision states with a single auxiliary state left by
+            ``symmetry_breaking`` are not counted. There are at most
+            ``2**(split_depth*num_auxiliary)`` subtrees.
+
+        symmetry_breaking:
+            If ``True``, only try auxiliary states that are not equivalent to
+            ones already covered by the search. Auxiliary variables can be
+            interchangeable under automorphisms of the graph that fix the
+            decision variables. When both bounds are symmetric about zero,
+            they can also be flipped along with the signs of their biases.
+
+        variable_order:
+            How ``method='backtrack'`` picks the next feasible decision state
+            to fix. ``'static'`` fixes them in order. ``'tightest'`` picks
+            the one with an auxiliary state that has the least slack in the
+            current solution. Can also be a callable, see :func:`backtrack`.
+
+        value_order:
+            The order in which ``method='backtrack'`` tries the auxiliary
+            states of a decision state. ``'static'`` tries them in order.
+            ``'relaxation'`` tries first the ones closest to being ground
+            states in the current solution. Can also be a callable, see
+            :func:`backtrack`.
+
+        decompose:
+            If ``True`` and the graph is disconnected, generate a penalty
+            model for each connected component independently when the table
+            allows it. See :func:`split_table`.
+
+        target_gap:
+            If given, the gap is only maximized if the first penalty model
+            found has a smaller gap. ``target_gap=min_classical_gap`` always
+            returns the first penalty model found, skipping the final linear
+            program.
+
+        timeout:
+            The time limit in seconds. If the search for a penalty model runs
+            out of time, :exc:`~penaltymodel.GenerationTimeout` is raised. If
+            a penalty model has already been found, it is returned with its
+            gap instead, without maximizing the gap any further.
+
+        cancel:
+            Setting this event from another thread stops generation as if
+            the time limit had been reached.
+
     """
+    deadline = Deadline(timeout, cancel)
+
+    if method not in ('backtrack', 'milp'):
+        raise ValueError(f"unknown method {method!r}, expected 'backtrack' or 'milp'")
+    if isinstance(variable_order, str):
+        try:
+            variable_order = VARIABLE_ORDERS[variable_order]
+        except KeyError:
+            raise ValueError(f"unknown variable_order {variable_order!r}, "
+                             f"expected one of {', '.join(map(repr, VARIABLE_ORDERS))}") from None
+    if isinstance(value_order, str):
+        try:
+            value_order = VALUE_ORDERS[value_order]
+        except KeyError:
+            raise ValueError(f"unknown value_order {value_order!r}, "
+                             f"expected one of {', '.join(map(repr, VALUE_ORDERS))}") from None
+
     graph = as_graph(graph_like)
     samples, decision = dimod.as_samples(samples_like)
 
@@ -149,128 +1437,268 @@ def generate(graph_like: GraphLike,
     else:
         energies = np.zeros(num_samples)
 
-    # construct the table
-    if len(energies):
-        table = {tuple(map(int, state)): energy for state, energy in zip(samples, energies)}
-    else:
-        table = {}
-
-    # todo: more correctness checks, max variables==8
+    if num_variables >= 64:
+        raise ValueError("graph must have fewer than 64 nodes")
 
     # some edge cases we can easily eliminate
-    if not table or not decision:
+    if not len(energies) or not decision:
         bqm = dimod.BinaryQuadraticModel('SPIN')
         bqm.add_linear_from((v, 0) for v in graph.nodes)
         bqm.add_quadratic_from((u, v, 0) for u, v in graph.edges)
         return bqm, float('inf'), {}
 
+    if decompose:
+        blocks = split_table(graph, decision, samples, energies)
+        if blocks is not None:
+            return generate_blocks(blocks, decision, samples, energies[0], deadline,
+                                   linear_bound=linear_bound,
+                                   quadratic_bound=quadratic_bound,
+                                   min_classical_gap=min_classical_gap,
+                                   cutting_planes=cutting_planes,
+                                   method=method,
+                                   workers=workers,
+                                   split_depth=split_depth,
+                                   symmetry_breaking=symmetry_breaking,
+                                   variable_order=variable_order,
+                                   value_order=value_order,
+                                   target_gap=target_gap,
+                                   )
+
     # create an object to track the columns in the LP matrix
 
     indexer = Index(decision, auxiliaries, graph.edges)
 
-    # we'll use this to track where the ground states are. Note that we could
-    # avoiding needing to store this in memory with some clever indexing, but
-    # let's not worry too much about that unless it becomes a problem later
-    ground: Dict[Tuple[int, ...], Dict[Tuple[int, ...], int]] = dict()
+    # construct the table. We encode each decision state as an integer, the
+    # same way as the rows of the LP matrix. The gap and b are how we
+    # distinguish between values in the table and not
+    table = pack_states(samples)
+    feasible = np.zeros(1 << len(decision), dtype=np.int8)
+    feasible[table] = 1
+    target = np.full(1 << len(decision), energies.max(), dtype=float)
+    target[table] = energies
 
-    # ok, let's build our matrices for the LP
-
-    b = np.full(1 << num_variables, max(table.values(), default=0), dtype=float)
-
-    A = np.empty((1 << len(graph), len(indexer)), dtype=np.int8)
-    A[:, indexer.variables()] = all_possible(num_variables)
-    for u, v in graph.edges:
-        A[:, indexer.interaction(u, v)] = A[:, indexer.variable(u)] * A[:, indexer.variable(v)]
-    A[:, indexer.offset()] = 1
-
-    # the gap and b are how we distinguish between values in the table and
-    # not
-    for i in range(1 << num_variables):
-        decision_state = tuple(A[i, indexer.decisions()])
-
-        if decision_state in table:
-            A[i, indexer.gap()] = 0
-            b[i] = table[decision_state]
-            ground.setdefault(decision_state, {})[tuple(A[i, indexer.auxiliaries()])] = i
-        else:
-            A[i, indexer.gap()] = -1
+    # ok, let's build our matrix for the LP
+    interactions = [(indexer.variable(u) - 2, indexer.variable(v) - 2) for u, v in graph.edges]
+    states = StateMatrix(indexer, interactions, feasible, target)
 
-    # for now we're just trying to find feasibility, we'll optimize at the end
-    c = np.zeros(len(indexer))
+    # the order in which we fix the decision states
+    ground = np.unique(table)
 
     # bounds are fixed
     bounds = indexer.make_bounds(min_classical_gap, linear_bound, quadratic_bound)
 
-    # ok, we have everything in hand to start solving!
-    upper_bound = list(range(A.shape[0]))
-    equality: List[int] = []
-    auxiliary_configurations: Dict[Tuple[int, ...], Tuple[int, ...]] = OrderedDict()
+    if cutting_planes:
+        # every feasible row, plus the rows < 1 << len(decision), which have
+        # every auxiliary at -1
+        rows = states.row(ground[:, np.newaxis], np.arange(1 << num_auxiliary)).ravel()
+        rows = np.union1d(rows, np.arange(1 << len(decision)))
+    else:
+        rows = None
 
-    # WLOG, we can fix one right away
-    decision_state = next(state for state in ground if state not in auxiliary_configurations)
-    auxiliary_configurations[decision_state] = auxiliary_state = (-1,)*num_auxiliary
-    i = ground[decision_state][auxiliary_state]
-    upper_bound.remove(i)
-    equality.append(i)
+    # ok, we have everything in hand to start solving! For now we're just
+    # trying to find feasibility, we'll optimize at the end
+    lp = linear_program(states, bounds, rows, deadline)
 
-    while True:
-        A_eq = A[equality, :]
-        b_eq = b[equality]
-        A_ub = -A[upper_bound, :]  # negate because we want A_ub <= b_ub
-        b_ub = -b[upper_bound]
+    if not num_auxiliary:
+        # there is nothing to search, so fix every feasible state and go
+        # straight to maximizing the gap
+        auxiliary_configurations = OrderedDict((decision_state, 0)
+                                               for decision_state in ground.tolist())
+        for decision_state in auxiliary_configurations:
+            lp.fix(states.row(decision_state, 0))
 
-        res = scipy.optimize.linprog(c, A_ub, b_ub, A_eq, b_eq, bounds=bounds, method='highs')
+        gap = lp.maximize_gap()
+        if gap is None:
+            raise ImpossiblePenaltyModel("There is no BQM that can encode the given constraint")
+        if lp.x is None:
+            # the gap is unbounded, but we still need a feasible solution
+            lp.solve()
+    else:
+        if symmetry_breaking:
+            gauge = (linear_bound[0] == -linear_bound[1]
+                     and quadratic_bound[0] == -quadratic_bound[1])
+            domains = auxiliary_domains(graph, decision, auxiliaries, gauge=gauge)
+        else:
+            domains = []
 
-        if res.success:
-            if len(auxiliary_configurations) == len(table):
-                break
-
-            # fix a new state
-            decision_state = next(state for state in ground if state not in auxiliary_configurations)
-            auxiliary_configurations[decision_state] = auxiliary_state = (-1,)*num_auxiliary
-            i = ground[decision_state][auxiliary_state]
-            upper_bound.remove(i)
-            equality.append(i)
+        if method == 'backtrack' and workers <= 1:
+            auxiliary_configurations = backtrack(lp, states, ground.tolist(), domains,
+                                                 variable_order=variable_order,
+                                                 value_order=value_order)
         else:
-            # ok, we didn't succeed. So first try changing the aux state of the
-            # last set
+            if method == 'backtrack':
+                auxiliary_configurations = parallel_backtrack(states, bounds, rows,
+                                                              ground.tolist(),
+                                                              workers=workers,
+                                                              split_depth=split_depth,
+                                                              domains=domains,
+                                                              variable_order=variable_order,
+                                                              value_order=value_order,
+                                                              deadline=deadline)
+            else:
+                auxiliary_configurations = milp(states, ground, bounds, domains, deadline)
+
+            # the assignment was found elsewhere, so fix it in our own program
+            for decision_state, auxiliary_state in auxiliary_configurations.items():
+                lp.fix(states.row(decision_state, auxiliary_state))
+            if not lp.solve():
+                raise RuntimeError("something went wrong")
+
+        # having found something feasible, let's do one last run, this time
+        # optimizing the gap, unless what we have is good enough
+        gap = lp.gap() if target_gap is not None else None
+        if gap is None or gap < target_gap:
+            x = lp.x
             try:
-                decision_state, auxiliary_state = auxiliary_configurations.popitem()
-                upper_bound.append(equality.pop())  # put it back into inequality
-                while all(s == 1 for s in auxiliary_state):
-                    decision_state, auxiliary_state = auxiliary_configurations.popitem()
-                    upper_bound.append(equality.pop())  # put it back into inequality
-            except KeyError:
-                raise ImpossiblePenaltyModel("There is no BQM that can encode the given constraint") from None
-
-            # iterate the auxiliary state
-            auxiliary_configurations[decision_state] = auxiliary_state = next_auxiliary(auxiliary_state)
-            i = ground[decision_state][auxiliary_state]
-            upper_bound.remove(i)
-            equality.append(i)
-
-    assert res.success
-
-    # having found something feasible, let's do one last run, this time optimizing the gap
-    c[indexer.gap()] = -1
-    res_opt = scipy.optimize.linprog(c, A_ub, b_ub, A_eq, b_eq, bounds=bounds, method='highs')
-    if res_opt.success:
-        res = res_opt
-        gap = res.x[indexer.gap()]
-    elif res_opt.status == 3:
-        # error code 3 is unbounded objective, which can happen for a fully
-        # specified problem
-        gap = float('inf')
-    else:
-        raise RuntimeError("something went wrong")
+                gap = lp.maximize_gap()
+            except GenerationTimeout:
+                # we have a penalty model, so return it rather than nothing
+                lp.x = x
+                gap = lp.gap()
+
+    # the solvers can overshoot the bounds, or undershoot the minimum gap, by
+    # a rounding error, which would keep the penalty model from being found
+    # in the cache
+    lower, upper = np.array([(-np.inf if low is None else low, np.inf if high is None else high)
+                             for low, high in bounds], dtype=float).T
+    x = np.clip(lp.x, lower, upper)
+    gap = max(gap, min_classical_gap)
 
     # let's make the BQM!
     bqm = dimod.BinaryQuadraticModel('SPIN')
-    bqm.add_linear_from((v, res.x[indexer.variable(v)]) for v in graph.nodes)
-    bqm.add_quadratic_from((u, v, res.x[indexer.interaction(u, v)]) for u, v in graph.edges)
-    bqm.offset = res.x[indexer.offset()]
+    bqm.add_linear_from((v, x[indexer.variable(v)]) for v in graph.nodes)
+    bqm.add_quadratic_from((u, v, x[indexer.interaction(u, v)]) for u, v in graph.edges)
+    bqm.offset = x[indexer.offset()]
 
     # return which auxiliary variables are which
-    aux = dict((state, dict(zip(auxiliaries, aux))) for state, aux in auxiliary_configurations.items())
+    decision_states = spin_configurations(list(auxiliary_configurations.keys()), len(decision))
+    auxiliary_states = spin_configurations(list(auxiliary_configurations.values()), num_auxiliary)
+    aux = dict((tuple(state), dict(zip(auxiliaries, aux)))
+               for state, aux in zip(decision_states.tolist(), auxiliary_states.tolist()))
 
     return bqm, gap, aux
+
+
+def table_key(samples_like) -> Tuple[Tuple[Variable, ...], bytes, bytes]:
+    """Return a hashable key that is equal for tables describing the same samples.
+
+    Samples given as 0/1 and as -1/+1 have the same key.
+    """
+    samples, labels = dimod.as_samples(samples_like)
+    if isinstance(samples_like, dimod.SampleSet):
+        energies = np.asarray(samples_like.record.energy, dtype=float)
+    else:
+        energies = np.zeros(samples.shape[0])
+    return tuple(labels), pack_states(samples).tobytes(), energies.tobytes()
+
+
+def spin_reversal(samples_like) -> Tuple[dimod.SampleSet, List[Variable]]:
+    """Flip some of the variables of a table of feasible states to a canonical form.
+
+    Tables over the same variables that differ only by flipping some of
+    them, and by the order of their samples, give the same table. See
+    :func:`~penaltymodel.utils.spin_reversals`.
+
+    Returns:
+        A 2-tuple of the flipped table, as a sample set with vartype
+        ``'SPIN'`` and the samples in order, and the variables that were
+        flipped.
+    """
+    samples, labels = dimod.as_samples(samples_like)
+    if isinstance(samples_like, dimod.SampleSet):
+        energies = np.asarray(samples_like.record.energy, dtype=float)
+    else:
+        energies = np.zeros(samples.shape[0])
+    samples = samples > 0
+
+    def key(flips):
+        return sorted(zip(pack_states(samples ^ flips).tolist(), energies.tolist()))
+
+    flips = min(spin_reversals(samples), key=key)
+    states, energies = zip(*key(flips)) if len(samples) else ((), ())
+
+    sampleset = dimod.SampleSet.from_samples(
+        (spin_configurations(states, len(labels)), labels), vartype='SPIN', energy=energies)
+    return sampleset, [v for v, flip in zip(labels, flips) if flip]
+
+
+def generate_many(graph_like: GraphLike,
+                  samples_likes: Iterable,
+                  *,
+                  linear_bound: Tuple[float, float] = (-2, 2),
+                  quadratic_bound: Tuple[float, float] = (-1, 1),
+                  reuse_flipped: bool = False,
+                  workers: int = 1,
+                  **kwargs,
+                  ) -> List[Tuple[dimod.BinaryQuadraticModel, float,
+                                  Dict[Tuple[int, ...], Tuple[int, ...]]]]:
+    """Generate a penalty model for each of several tables on the same graph.
+
+    The graph is converted once and identical tables are only generated
+    once, see :func:`table_key`.
+
+    Args:
+        graph_like: The structure shared by every penalty model, see
+            :func:`generate`.
+        samples_likes: The tables.
+        linear_bound: Passed to :func:`generate`.
+        quadratic_bound: Passed to :func:`generate`.
+        reuse_flipped: If ``True`` and both bounds are symmetric about zero,
+            tables that only differ by flipping some of their variables are
+            also generated once, see :func:`spin_reversal`. The penalty model
+            for the others is found by flipping the same variables, which
+            negates their linear biases and the quadratic biases of their
+            interactions.
+        workers: If greater than one and there is more than one distinct
+            table, the tables are generated in a process pool. Otherwise it
+            is passed to :func:`generate`.
+        **kwargs: Passed to :func:`generate`.
+
+    Returns:
+        The result of :func:`generate` for each table, in order.
+
+    Raises:
+        ImpossiblePenaltyModel: If any of the tables has no penalty model.
+
+    """
+    graph = as_graph(graph_like)
+    kwargs.update(linear_bound=linear_bound, quadratic_bound=quadratic_bound)
+
+    samples_likes = list(samples_likes)
+    symmetric = linear_bound[0] == -linear_bound[1] and quadratic_bound[0] == -quadratic_bound[1]
+    if reuse_flipped and symmetric and samples_likes:
+        samples_likes, flips = zip(*map(spin_reversal, samples_likes))
+    else:
+        flips = [[]] * len(samples_likes)
+    keys = [table_key(samples_like) for samples_like in samples_likes]
+
+    # the first of each distinct table
+    unique: Dict[Tuple, int] = {}
+    for i, key in enumerate(keys):
+        unique.setdefault(key, i)
+    tables = [samples_likes[i] for i in unique.values()]
+
+    if workers > 1 and len(tables) > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(functools.partial(generate, graph, **kwargs), tables))
+    else:
+        results = [generate(graph, samples_like, workers=workers, **kwargs)
+                   for samples_like in tables]
+
+    models = dict(zip(unique, results))
+
+    penalty_models = []
+    for i, (key, flipped) in enumerate(zip(keys, flips)):
+        bqm, gap, aux = models[key]
+        if unique[key] != i or flipped:
+            # don't share the results between repeated tables
+            bqm = bqm.copy()
+            aux = dict((state, dict(auxiliary)) for state, auxiliary in aux.items())
+        if flipped:
+            for v in flipped:
+                bqm.flip_variable(v)
+            signs = [-1 if v in flipped else 1 for v in keys[i][0]]
+            aux = dict((tuple(sign * s for sign, s in zip(signs, state)), auxiliary)
+                       for state, auxiliary in aux.items())
+        penalty_models.append((bqm, gap, aux))
+    return penalty_models
@@ -14,9 +14,12 @@
 
 r"""This package implements the generation and caching of :term:`penalty model`\ s."""
 
+import contextlib
 import copy
+import threading
 
-from typing import Mapping, Optional, Sequence, Tuple
+from collections import defaultdict
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 import dimod
 import networkx as nx
@@ -25,10 +28,10 @@ from dimod.typing import Variable
 
 from penaltymodel.database import PenaltyModelCache
 from penaltymodel.exceptions import MissingPenaltyModel
-from penaltymodel.generation import generate
+from penaltymodel.generation import Deadline, generate, generate_many, table_key
 from penaltymodel.typing import GraphLike
 
-__all__ = ['get_penalty_model']
+__all__ = ['get_penalty_model', 'get_penalty_models']
 
 
 def get_penalty_model(samples_like,
@@ -38,6 +41,9 @@ def get_penalty_model(samples_like,
                       quadratic_bound: Tuple[float, float] = (-1, 1),
                       min_classical_gap: float = 2,
                       use_cache: bool = True,
+                      workers: int = 1,
+                      timeout: Optional[float] = None,
+                      cancel: Optional[threading.Event] = None,
                       ) -> Tuple[dimod.BinaryQuadraticModel, float]:
     """Get a penalty model for a specific graph and set of target states.
 
@@ -88,6 +94,22 @@ def get_penalty_model(samples_like,
             Whether to attempt to retrieve models from the cache. If ``False``,
             a new model will always be generated.
 
+        workers:
+            The number of processes used to search for a penalty model when
+            one is generated. If greater than one, the search is split across
+            a process pool.
+
+        timeout:
+            The time limit in seconds for generating a penalty model. If a
+            penalty model is found but its gap has not been maximized in
+            time, it is returned anyway. A penalty model generated when the
+            time limit is reached, or after ``cancel`` is set, is not added
+            to the cache because its gap may not be the best one.
+
+        cancel:
+            Setting this event from another thread stops generation as if
+            the time limit had been reached.
+
     Returns:
         A 2-tuple of the binary quadratic model and the classical gap. Note
         that the binary quadratic model always has vartype ``'SPIN'``.
@@ -97,6 +119,10 @@ def get_penalty_model(samples_like,
             If it is not possible to construct a penalty model for the given
             structure and feasible states.
 
+        GenerationTimeout:
+            If no penalty model is found within ``timeout`` or before
+            ``cancel`` is set.
+
     Examples:
 
         >>> import dimod
@@ -132,7 +158,7 @@ def get_penalty_model(samples_like,
         graph_like = nx.complete_graph(labels)
 
     if use_cache:
-        with PenaltyModelCache() as cache:
+        with PenaltyModelCache(shared=True, memory=True) as cache:
             try:
                 return cache.retrieve(samples_like=samples_like,
                                       graph_like=graph_like,
@@ -143,15 +169,143 @@ def get_penalty_model(samples_like,
             except MissingPenaltyModel:
                 pass  # generate
 
+    deadline = Deadline(timeout, cancel)
+
     bqm, gap, _ = generate(graph_like=graph_like,
                            samples_like=samples_like,
                            linear_bound=linear_bound,
                            quadratic_bound=quadratic_bound,
                            min_classical_gap=min_classical_gap,
+                           workers=workers,
+                           timeout=timeout,
+                           cancel=cancel,
                            )
 
-    if use_cache:
-        with PenaltyModelCache() as cache:
+    # if generation was cut short, the gap may not have been maximized and the
+    # cache would return this penalty model in place of better ones
+    if use_cache and not deadline.expired():
+        with PenaltyModelCache(shared=True, memory=True) as cache:
             cache.insert_penalty_model(bqm, samples_like, gap)
 
     return bqm, gap
+
+
+def get_penalty_models(samples_likes: Iterable,
+                       graph_like: Optional[GraphLike] = None,
+                       *,
+                       linear_bound: Tuple[float, float] = (-2, 2),
+                       quadratic_bound: Tuple[float, float] = (-1, 1),
+                       min_classical_gap: float = 2,
+                       use_cache: bool = True,
+                       workers: int = 1,
+                       ) -> List[Tuple[dimod.BinaryQuadraticModel, float]]:
+    """Get a penalty model for each of several sets of target states.
+
+    This is equivalent to calling :func:`get_penalty_model` for each of
+    ``samples_likes``, but identical sets of target states are only looked
+    up or generated once. When the bounds are symmetric about zero, so are
+    sets of target states that differ only by flipping some of their
+    variables. The cache is queried for the whole batch at once and the
+    generated penalty models are inserted together.
+
+    Args:
+        samples_likes:
+            The sets of feasible states, each as described for
+            :func:`get_penalty_model`.
+
+        graph_like:
+            Defines the structure shared by every binary quadratic model, see
+            :func:`get_penalty_model`. If not provided, each binary quadratic
+            model is fully connected over the variables of its
+            ``samples_like``.
+
+        workers:
+            The number of processes used to generate the penalty models that
+            are not in the cache.
+
+    See :func:`get_penalty_model` for a description of the remaining
+    arguments.
+
+    Returns:
+        A list of 2-tuples of the binary quadratic model and the classical
+        gap, in the same order as ``samples_likes``.
+
+    Raises:
+        ImpossiblePenaltyModel:
+            If it is not possible to construct a penalty model for any of the
+            sets of feasible states.
+
+    Examples:
+
+        >>> import penaltymodel
+
+        This example generates penalty models for an AND gate and an OR
+        gate.
+
+        >>> models = penaltymodel.get_penalty_models([[[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]],
+        ...                                           [[0, 0, 0], [0, 1, 1], [1, 0, 1], [1, 1, 1]]])
+        >>> for bqm, gap in models:
+        ...     print(gap)
+        2.0
+        2.0
+
+    """
+    samples_likes = list(samples_likes)
+    keys = [table_key(samples_like) for samples_like in samples_likes]
+
+    # the first of each distinct table
+    unique: Dict[Tuple, int] = {}
+    for i, key in enumerate(keys):
+        unique.setdefault(key, i)
+
+    models: Dict[Tuple, Tuple[dimod.BinaryQuadraticModel, float]] = {}
+
+    if use_cache:
+        cache_context = PenaltyModelCache(shared=True, memory=True)
+    else:
+        cache_context = contextlib.nullcontext()
+    with cache_context as cache:
+        if use_cache:
+            retrieved, _ = cache.retrieve_many(
+                [(samples_likes[i], graph_like if graph_like is not None else key[0])
+                 for key, i in unique.items()],
+                linear_bound=linear_bound,
+                quadratic_bound=quadratic_bound,
+                min_classical_gap=min_classical_gap,
+                )
+            models.update((key, penalty_model)
+                          for key, penalty_model in zip(unique, retrieved)
+                          if penalty_model is not None)
+
+        # by default each table gets a complete graph over its own variables,
+        # so group the missing tables by graph
+        missing = defaultdict(list)
+        for key, i in unique.items():
+            if key not in models:
+                missing[key[0] if graph_like is None else None].append(i)
+
+        for labels, indices in missing.items():
+            graph = nx.complete_graph(labels) if graph_like is None else graph_like
+            generated = generate_many(graph,
+                                      [samples_likes[i] for i in indices],
+                                      linear_bound=linear_bound,
+                                      quadratic_bound=quadratic_bound,
+                                      min_classical_gap=min_classical_gap,
+                                      reuse_flipped=True,
+                                      workers=workers,
+                                      )
+
+            for i, (bqm, gap, _) in zip(indices, generated):
+                models[keys[i]] = bqm, gap
+
+            if use_cache:
+                cache.insert_penalty_models((bqm, samples_likes[i], gap)
+                                            for i, (bqm, gap, _) in zip(indices, generated))
+
+    penalty_models = []
+    for i, key in enumerate(keys):
+        bqm, gap = models[key]
+        if unique[key] != i:
+            bqm = bqm.copy()  # don't share the bqm between repeated tables
+        penalty_models.append((bqm, gap))
+    return penalty_models
@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Mapping, Optional, Sequence, Tuple
+import itertools
+
+from typing import List, Mapping, Optional, Sequence, Tuple
 
 import dimod
 import networkx as nx
@@ -44,6 +46,42 @@ def as_graph(graph_like: GraphLike) -> nx.Graph:
     return graph_like if isinstance(graph_like, nx.Graph) else nx.complete_graph(graph_like)
 
 
+def spin_reversals(samples: np.ndarray, max_tied: int = 4) -> List[np.ndarray]:
+    """Return the spin reversals that put a table of feasible states in canonical form.
+
+    Flipping a decision variable of a penalty model, and negating its linear
+    bias and the quadratic biases of its interactions, gives a penalty model
+    for the table with that column flipped.
+
+    Args:
+        samples: A boolean array with a row for each feasible state.
+        max_tied: The most columns with as many ones as zeros to try both
+            ways.
+
+    Returns:
+        A list of boolean arrays, each marking the columns to flip. Columns
+        with more ones than zeros are always flipped. Every combination of
+        flips of the columns with as many of each is returned, unless there
+        are more than ``max_tied`` of them, in which case they are not
+        flipped. Tables that are flips of each other give the same set of
+        flipped tables.
+
+    """
+    ones = 2 * np.count_nonzero(samples, axis=0)
+    flips = ones > samples.shape[0]
+    tied = np.flatnonzero(ones == samples.shape[0])
+
+    if len(tied) > max_tied:
+        return [flips]
+
+    reversals = []
+    for tied_flips in itertools.product([False, True], repeat=len(tied)):
+        reversal = flips.copy()
+        reversal[tied] = tied_flips
+        reversals.append(reversal)
+    return reversals
+
+
 def table_to_sampleset(table: Mapping[Tuple[int, ...], float],
                        decision: Sequence[Variable],
                        vartype: Optional[VartypeLike] = None) -> dimod.SampleSet:
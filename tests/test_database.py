@@ -12,14 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
 import unittest
+import unittest.mock
 
 import dimod
 import networkx as nx
 import numpy as np
 
 from penaltymodel import MissingPenaltyModel
-from penaltymodel.database import patch_cache
+from penaltymodel.database import (MemoryCache, PenaltyModelCache, canonical_form, isolated_cache,
+                                   patch_cache)
+
+
+def shared_connection(database):
+    # run in a forked process by TestSharedConnections
+    with PenaltyModelCache(database, shared=True) as cache:
+        return id(cache.conn), len(list(cache.iter_samplesets()))
+
+
+def insert_and_retrieve(database, seed, num_models=25):
+    # run in another process by TestConcurrency
+    rng = np.random.default_rng(seed)
+    with PenaltyModelCache(database) as cache:
+        for _ in range(num_models):
+            samples = np.unique(rng.integers(0, 2, size=(4, 4)), axis=0)
+            bqm = dimod.generators.gnp_random_bqm(6, 1, 'SPIN',
+                                                  random_state=int(rng.integers(1 << 30)))
+            bqm.normalize((-1, 1))
+            cache.insert_penalty_model(bqm, samples, 1)
+            new, _ = cache.retrieve(samples, 6, linear_bound=(-1, 1), min_classical_gap=1)
+            assert new.num_variables == 6
+    return num_models
 
 
 class TestBQMCache(unittest.TestCase):
@@ -99,7 +130,8 @@ class TestPenaltyModelCache(unittest.TestCase):
     @patch_cache()
     def test_and_gate_insert_retrieve(self, cache):
         classical_gap = 2
-        bqm = dimod.generators.and_gate(0, 1, 2, strength=classical_gap).change_vartype('SPIN', inplace=True)
+        bqm = dimod.generators.and_gate(0, 1, 2, strength=classical_gap)
+        bqm.change_vartype('SPIN', inplace=True)
         sampleset = dimod.ExactSolver().sample(bqm).lowest()
 
         cache.insert_penalty_model(bqm, sampleset, classical_gap)
@@ -107,12 +139,65 @@ class TestPenaltyModelCache(unittest.TestCase):
         li = list(cache.iter_penalty_models())
         self.assertEqual(len(li), 1)
         pm, = li
-        self.assertEqual(pm.bqm, bqm)
-        data = list(pm.sampleset.data())
-        for datum in sampleset.data():
-            self.assertIn(datum, data)
+        # stored relabelled to its canonical order
+        self.assertEqual(pm.bqm.variables ^ bqm.variables, set())
+        ground = dimod.ExactSolver().sample(pm.bqm).lowest()
+        self.assertEqual({tuple(sorted(sample.items())) for sample in ground.samples()},
+                         {tuple(sorted(sample.items())) for sample in pm.sampleset.samples()})
+        self.assertEqual(len(pm.sampleset), len(sampleset))
         self.assertEqual(pm.classical_gap, classical_gap)
 
+        self.assertEqual(cache.retrieve(sampleset, bqm.variables, quadratic_bound=(-2, 2)),
+                         (bqm, classical_gap))
+
+    @patch_cache()
+    def test_insert_many(self, cache):
+        and_bqm = dimod.generators.and_gate('a', 'b', 'c', strength=2)
+        and_bqm.change_vartype('SPIN', inplace=True)
+        or_bqm = dimod.generators.or_gate('a', 'b', 'c', strength=2)
+        or_bqm.change_vartype('SPIN', inplace=True)
+        penalty_models = [(bqm, dimod.ExactSolver().sample(bqm).lowest(), 2)
+                          for bqm in [and_bqm, or_bqm]]
+
+        cache.insert_penalty_models(penalty_models + penalty_models[:1])
+
+        # an OR gate is an AND gate with every variable flipped
+        self.assertEqual(len(list(cache.iter_penalty_models())), 1)
+        for bqm, samples_like, gap in penalty_models:
+            new, new_gap = cache.retrieve(samples_like, bqm.variables, quadratic_bound=(-2, 2))
+            self.assertEqual(new, bqm)
+            self.assertEqual(new_gap, gap)
+
+    @patch_cache()
+    def test_insert_many_atomic(self, cache):
+        bqm = dimod.generators.and_gate(0, 1, 2, strength=2).change_vartype('SPIN', inplace=True)
+        sampleset = dimod.ExactSolver().sample(bqm).lowest()
+
+        # the second penalty model is invalid, so neither is inserted
+        with self.assertRaises(ValueError):
+            cache.insert_penalty_models([(bqm, sampleset, 2), (bqm, [[0, 1, 0, 1]], 2)])
+        self.assertEqual(list(cache.iter_penalty_models()), [])
+
+        cache.insert_penalty_models([])
+        self.assertEqual(list(cache.iter_penalty_models()), [])
+
+    def test_insert_many_workers(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        penalty_models = []
+        for gap in [1, 2]:
+            bqm = dimod.generators.and_gate(0, 1, 2, strength=gap)
+            bqm.change_vartype('SPIN', inplace=True)
+            penalty_models.append((bqm, dimod.ExactSolver().sample(bqm).lowest(), gap))
+
+        models = []
+        for workers, database in [(1, 'serial.db'), (2, 'parallel.db')]:
+            with PenaltyModelCache(os.path.join(tmpdir.name, database)) as cache:
+                cache.insert_penalty_models(penalty_models, workers=workers)
+                models.append(sorted(pm.classical_gap for pm in cache.iter_penalty_models()))
+        self.assertEqual(models, [[1, 2], [1, 2]])
+
 
 class TestRetrieve(unittest.TestCase):
     @patch_cache()
@@ -129,13 +214,77 @@ class TestRetrieve(unittest.TestCase):
         bqm, classical_gap = cache.retrieve(samples, nx.complete_graph(3))
         self.assertEqual(bqm, bqm2)  # largest gap, fits within bounds
 
-        bqm, classical_gap = cache.retrieve(samples, nx.complete_graph(3), linear_bound=(-.5, .5), min_classical_gap=1)
+        bqm, classical_gap = cache.retrieve(samples, nx.complete_graph(3), linear_bound=(-.5, .5),
+                                            min_classical_gap=1)
         self.assertEqual(bqm, bqm1)  # since this fits in the given bounds
 
         with self.assertRaises(MissingPenaltyModel):
             cache.retrieve(samples, nx.complete_graph(3), linear_bound=(-.5, .5))
 
 
+class TestRetrieveMany(unittest.TestCase):
+    @patch_cache()
+    def test_hits_and_misses(self, cache):
+        and_bqm = dimod.generators.and_gate('a', 'b', 'c', strength=2)
+        and_bqm.change_vartype('SPIN', inplace=True)
+        or_bqm = dimod.generators.or_gate(0, 1, 2, strength=2).change_vartype('SPIN', inplace=True)
+        and_samples = dimod.ExactSolver().sample(and_bqm).lowest()
+        or_samples = dimod.ExactSolver().sample(or_bqm).lowest()
+
+        cache.insert_penalty_models([(and_bqm, and_samples, 2), (or_bqm, or_samples, 2)])
+
+        specs = [(and_samples, and_bqm.variables),
+                 ([[0, 1], [1, 0]], 2),
+                 (or_samples, 3),
+                 (and_samples, and_bqm.variables)]
+        penalty_models, misses = cache.retrieve_many(specs, quadratic_bound=(-2, 2))
+
+        self.assertEqual(misses, [1])
+        self.assertEqual(penalty_models[0], (and_bqm, 2))
+        self.assertIsNone(penalty_models[1])
+        self.assertEqual(penalty_models[2], (or_bqm, 2))
+        self.assertEqual(penalty_models[3], (and_bqm, 2))
+        self.assertIsNot(penalty_models[3][0], penalty_models[0][0])
+
+        # the same as one at a time
+        for (samples_like, graph_like), penalty_model in zip(specs, penalty_models):
+            if penalty_model is None:
+                with self.assertRaises(MissingPenaltyModel):
+                    cache.retrieve(samples_like, graph_like, quadratic_bound=(-2, 2))
+            else:
+                self.assertEqual(cache.retrieve(samples_like, graph_like, quadratic_bound=(-2, 2)),
+                                 penalty_model)
+
+        # the gap applies to every spec
+        penalty_models, misses = cache.retrieve_many(specs, quadratic_bound=(-2, 2),
+                                                     min_classical_gap=3)
+        self.assertEqual(misses, [0, 1, 2, 3])
+
+    @patch_cache()
+    def test_best_gap(self, cache):
+        samples = [[-1, -1], [+1, +1]]
+        for gap in [1, 3, 2]:
+            bqm = dimod.BQM({}, {(0, 1): -gap / 2}, -gap / 2, 'SPIN')
+            cache.insert_penalty_model(bqm, samples, gap)
+
+        (penalty_model,), misses = cache.retrieve_many([(samples, 2)], min_classical_gap=1)
+        self.assertEqual(misses, [])
+        self.assertEqual(penalty_model[1], 2)  # 3 is out of bounds
+
+    @patch_cache()
+    def test_chunked(self, cache):
+        cache.insert_penalty_model(dimod.BQM({}, {(0, 1): -1}, -1, 'SPIN'), [[-1, -1], [+1, +1]], 2)
+
+        specs = [([[-1, -1], [+1, +1]], 2), ([[-1, -1], [-1, +1], [+1, +1]], 2)] * 3
+        with unittest.mock.patch.object(PenaltyModelCache, 'max_query_size', 1):
+            penalty_models, misses = cache.retrieve_many(specs)
+        self.assertEqual(misses, [1, 3, 5])
+
+    @patch_cache()
+    def test_empty(self, cache):
+        self.assertEqual(cache.retrieve_many([]), ([], []))
+
+
 class TestSampleSetCache(unittest.TestCase):
     @patch_cache()
     def test_sampleset_insert_retrieve(self, cache):
@@ -150,3 +299,484 @@ class TestSampleSetCache(unittest.TestCase):
         cache.insert_sampleset(samples)
         sampleset, = cache.iter_samplesets()
         np.testing.assert_array_equal(samples, sampleset.record.sample)
+
+
+class TestSharedConnections(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.database = os.path.join(tmpdir.name, 'cache.db')
+        self.addCleanup(PenaltyModelCache.close_shared_connections)
+
+    def test_reuse(self):
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            conn = cache.conn
+            cache.insert_sampleset([[0, 1]])
+
+        # the connection survives the cache
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            self.assertIs(cache.conn, conn)
+            self.assertEqual(len(list(cache.iter_samplesets())), 1)
+
+        # but not unshared caches
+        with PenaltyModelCache(self.database) as cache:
+            self.assertIsNot(cache.conn, conn)
+            self.assertEqual(len(list(cache.iter_samplesets())), 1)
+
+        PenaltyModelCache.close_shared_connections(self.database)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1;")
+
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            self.assertIsNot(cache.conn, conn)
+
+    def test_threads(self):
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            conn = cache.conn
+
+        connections = []
+
+        def target():
+            with PenaltyModelCache(self.database, shared=True) as cache:
+                connections.append(cache.conn)
+                self.assertEqual(list(cache.iter_samplesets()), [])
+            PenaltyModelCache.close_shared_connections()
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(len(connections), 1)
+        self.assertIsNot(connections[0], conn)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), "needs fork")
+    def test_fork(self):
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            cache.insert_sampleset([[0, 1]])
+            conn = cache.conn
+
+        # a forked process opens its own connection rather than using ours
+        with concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('fork')) as executor:
+            future = executor.submit(shared_connection, self.database)
+            connection_id, num_samplesets = future.result()
+        self.assertNotEqual(connection_id, id(conn))
+        self.assertEqual(num_samplesets, 1)
+
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            self.assertIs(cache.conn, conn)
+
+    def test_recreated(self):
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            cache.insert_sampleset([[0, 1]])
+        PenaltyModelCache.close_shared_connections()
+
+        # the schema is created again if the file goes away
+        os.remove(self.database)
+        with PenaltyModelCache(self.database, shared=True) as cache:
+            self.assertEqual(list(cache.iter_samplesets()), [])
+
+    def test_isolated_cache(self):
+        with isolated_cache():
+            with PenaltyModelCache(shared=True) as cache:
+                conn = cache.conn
+
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1;")
+
+
+class TestSpecHash(unittest.TestCase):
+    def test_index(self):
+        with PenaltyModelCache(':memory:') as cache:
+            plan = cache.conn.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM penalty_model WHERE spec_hash = ?;",
+                (b'',)).fetchall()
+        self.assertIn('penalty_model_spec_hash', ' '.join(row['detail'] for row in plan))
+
+    def test_migrate(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        database = os.path.join(tmpdir.name, 'cache.db')
+
+        bqm = dimod.BQM({0: -1, 1: 1}, {(0, 1): -1}, 1.5, 'SPIN')
+        samples_like = dimod.SampleSet.from_samples([[-1, -1], [+1, +1]], energy=[0, 0],
+                                                    vartype='SPIN')
+
+        # a database from before the spec_hash column
+        old_schema = PenaltyModelCache.database_schema.replace(
+            "spec_hash BLOB,  -- see encode_spec", "")
+        old_insert = PenaltyModelCache.insert_penalty_model_statement.replace(
+            "bqm_id,\n            spec_hash)", "bqm_id)").replace(
+            "binary_quadratic_model.id,\n            :spec_hash", "binary_quadratic_model.id")
+        with unittest.mock.patch.multiple(PenaltyModelCache,
+                                          database_schema=old_schema,
+                                          database_index="",
+                                          insert_penalty_model_statement=old_insert,
+                                          _migrate=unittest.mock.DEFAULT):
+            with PenaltyModelCache(database) as cache:
+                cache.insert_penalty_model(bqm, samples_like, 2)
+                columns = [row['name']
+                           for row in cache.conn.execute("PRAGMA table_info(penalty_model);")]
+                self.assertNotIn('spec_hash', columns)
+        PenaltyModelCache._initialized.discard(database)
+
+        with PenaltyModelCache(database) as cache:
+            self.assertEqual(cache.retrieve(samples_like, 2, linear_bound=(-1, 1)), (bqm, 2))
+
+
+class TestEncodings(unittest.TestCase):
+    def test_binary(self):
+        parameters = PenaltyModelCache.encode_graph(nx.Graph([(2, 0), (1, 2)]))
+        self.assertEqual(parameters['edges'], np.array([0, 2, 1, 2], dtype='<u4').tobytes())
+
+        parameters = PenaltyModelCache.encode_sampleset(
+            dimod.SampleSet.from_samples([[+1, -1, +1], [-1, -1, -1]], energy=[.5, 0],
+                                         vartype='SPIN'))
+        self.assertEqual(parameters['samples'], np.array([0, 0b101], dtype='<u4').tobytes())
+        self.assertEqual(parameters['energies'], np.array([0, .5], dtype='<f8').tobytes())
+
+    def test_empty(self):
+        graph = PenaltyModelCache.decode_graph(PenaltyModelCache.encode_graph(nx.empty_graph(3)))
+        self.assertEqual(set(graph.nodes), {0, 1, 2})
+        self.assertEqual(len(graph.edges), 0)
+
+        row = PenaltyModelCache.encode_sampleset(np.empty((0, 3)))
+        sampleset = PenaltyModelCache.decode_sampleset(row)
+        self.assertEqual(sampleset.record.sample.shape, (0, 3))
+
+    def test_bqm(self):
+        bqms = [dimod.BQM({0: -1, 1: .5, 2: 0}, {(2, 0): -1, (0, 1): .25}, 1.5, 'SPIN'),
+                dimod.BQM({0: 1}, {(0, 1): -2}, 0, 'BINARY')]
+        for bqm in bqms:
+            with self.subTest(bqm=bqm):
+                new = PenaltyModelCache.decode_bqm(PenaltyModelCache.encode_bqm(bqm))
+                self.assertIs(new.vartype, dimod.SPIN)
+                self.assertEqual(new, bqm.change_vartype('SPIN', inplace=False))
+                self.assertEqual(list(new.variables), list(range(bqm.num_variables)))
+
+        # the encoding does not depend on the order the interactions were added
+        bqm = dimod.BQM({0: -1, 1: .5, 2: 0}, {(0, 1): .25, (2, 0): -1}, 1.5, 'SPIN')
+        self.assertEqual(PenaltyModelCache.encode_bqm(bqm), PenaltyModelCache.encode_bqm(bqms[0]))
+
+    def test_migrate_file_format(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        database = os.path.join(tmpdir.name, 'cache.db')
+
+        bqm = dimod.BQM({0: -1, 1: 1}, {(0, 1): -1}, 1.5, 'SPIN')
+        samples_like = dimod.SampleSet.from_samples([[-1, -1], [+1, +1]], energy=[0, 0],
+                                                    vartype='SPIN')
+        with PenaltyModelCache(database) as cache:
+            cache.insert_penalty_model(bqm, samples_like, 2)
+            encoded = cache.conn.execute("SELECT bqm_data FROM binary_quadratic_model;").fetchone()
+        PenaltyModelCache._initialized.discard(database)
+
+        # rewrite it the way version 1 of the schema stored bqms
+        conn = sqlite3.connect(database)
+        with bqm.to_file() as f:
+            conn.execute("UPDATE binary_quadratic_model SET bqm_data = ?;", (f.read(),))
+        conn.execute("PRAGMA user_version = 1;")
+        conn.commit()
+        conn.close()
+
+        with PenaltyModelCache(database) as cache:
+            migrated = cache.conn.execute("SELECT bqm_data FROM binary_quadratic_model;").fetchone()
+            self.assertEqual(migrated['bqm_data'], encoded['bqm_data'])
+            self.assertEqual(cache.retrieve(samples_like, 2, linear_bound=(-1, 1)), (bqm, 2))
+
+    def test_migrate_text(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        database = os.path.join(tmpdir.name, 'cache.db')
+
+        bqm = dimod.BQM({0: -1, 1: 1}, {(0, 1): -1}, 1.5, 'SPIN')
+        samples_like = dimod.SampleSet.from_samples([[-1, -1], [+1, +1]], energy=[0, 0],
+                                                    vartype='SPIN')
+        with PenaltyModelCache(database) as cache:
+            cache.insert_penalty_model(bqm, samples_like, 2)
+            encoded = cache.conn.execute("SELECT * FROM penalty_model_view;").fetchone()
+        PenaltyModelCache._initialized.discard(database)
+
+        # rewrite it the way version 0 of the schema stored edges and samples
+        conn = sqlite3.connect(database)
+        edges = np.frombuffer(encoded['edges'], dtype='<u4').reshape(-1, 2).tolist()
+        samples = np.frombuffer(encoded['samples'], dtype='<u4').tolist()
+        conn.execute("UPDATE graph SET edges = ?;", (json.dumps(edges, separators=(',', ':')),))
+        conn.execute("UPDATE sampleset SET samples = ?;",
+                     (json.dumps(samples, separators=(',', ':')),))
+        conn.execute("UPDATE penalty_model SET spec_hash = NULL;")
+        conn.execute("PRAGMA user_version = 0;")
+        conn.commit()
+        conn.close()
+
+        with PenaltyModelCache(database) as cache:
+            self.assertEqual(cache.conn.execute("PRAGMA user_version;").fetchone()[0],
+                             PenaltyModelCache.schema_version)
+            migrated = cache.conn.execute("SELECT * FROM penalty_model_view;").fetchone()
+            for key in ['edges', 'samples', 'energies']:
+                self.assertEqual(migrated[key], encoded[key])
+
+            self.assertEqual(cache.retrieve(samples_like, 2, linear_bound=(-1, 1)), (bqm, 2))
+            self.assertEqual(list(cache.iter_graphs())[0].edges, nx.Graph(edges).edges)
+
+
+class TestMemoryCache(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.database = os.path.join(tmpdir.name, 'cache.db')
+        self.addCleanup(PenaltyModelCache.memory_cache.clear)
+
+        self.samples_like = dimod.SampleSet.from_samples([[-1, -1], [+1, +1]], energy=[0, 0],
+                                                         vartype='SPIN')
+
+    def test_retrieve(self):
+        bqm = dimod.BQM({0: -1, 1: 1}, {(0, 1): -1}, 1.5, 'SPIN')
+
+        with PenaltyModelCache(self.database, memory=True) as cache:
+            cache.insert_penalty_model(bqm, self.samples_like, 2)
+            self.assertEqual(cache.retrieve(self.samples_like, 2), (bqm, 2))
+
+            # now it's in memory, so we don't need the database
+            with unittest.mock.patch.object(PenaltyModelCache, 'decode_bqm',
+                                            side_effect=Exception('boom')):
+                new, gap = cache.retrieve(self.samples_like, 2)
+            self.assertEqual((new, gap), (bqm, 2))
+
+            # we get copies
+            new.set_linear(0, 100)
+            self.assertEqual(cache.retrieve(self.samples_like, 2), (bqm, 2))
+
+        # other caches without memory still go to the database
+        with PenaltyModelCache(self.database) as cache:
+            with unittest.mock.patch.object(PenaltyModelCache, 'decode_bqm',
+                                            side_effect=Exception('boom')):
+                with self.assertRaises(Exception):
+                    cache.retrieve(self.samples_like, 2)
+
+    def test_invalidate(self):
+        bqm = dimod.BQM({0: -1, 1: 1}, {(0, 1): -1}, 1.5, 'SPIN')
+        better = dimod.BQM({0: 0, 1: 0}, {(0, 1): -2}, 2, 'SPIN')
+
+        with PenaltyModelCache(self.database, memory=True) as cache:
+            cache.insert_penalty_model(bqm, self.samples_like, 2)
+            self.assertEqual(cache.retrieve(self.samples_like, 2, quadratic_bound=(-2, 2)),
+                             (bqm, 2))
+
+        # inserting through any cache in the process forgets the old one
+        with PenaltyModelCache(self.database) as cache:
+            cache.insert_penalty_model(better, self.samples_like, 4)
+
+        with PenaltyModelCache(self.database, memory=True) as cache:
+            self.assertEqual(cache.retrieve(self.samples_like, 2, quadratic_bound=(-2, 2)),
+                             (better, 4))
+
+    def test_in_memory_database(self):
+        with PenaltyModelCache(':memory:', memory=True) as cache:
+            self.assertFalse(cache.memory)
+
+    def test_limits(self):
+        bqm = dimod.BQM({0: 1}, {}, 0, 'SPIN')
+
+        memory_cache = MemoryCache(maxsize=2, max_bytes=100)
+        memory_cache.put(('db', b'a'), bqm, 1, 10)
+        memory_cache.put(('db', b'b'), bqm, 1, 10)
+        memory_cache.get(('db', b'a'))
+        memory_cache.put(('db', b'c'), bqm, 1, 10)
+
+        # b was the least recently used
+        self.assertIsNone(memory_cache.get(('db', b'b')))
+        self.assertIsNotNone(memory_cache.get(('db', b'a')))
+        self.assertEqual(len(memory_cache), 2)
+
+        memory_cache.put(('db', b'd'), bqm, 1, 91)
+        self.assertEqual(len(memory_cache), 1)
+        self.assertEqual(memory_cache.nbytes, 91)
+
+        # too big to keep at all
+        memory_cache.put(('db', b'e'), bqm, 1, 101)
+        self.assertIsNone(memory_cache.get(('db', b'e')))
+
+        memory_cache.invalidate('db', b'd')
+        self.assertEqual(len(memory_cache), 0)
+        self.assertEqual(memory_cache.nbytes, 0)
+
+
+class TestCanonicalization(unittest.TestCase):
+    def setUp(self):
+        # an AND gate with two auxiliary variables, x and y
+        self.graph = nx.Graph([('a', 'b'), ('a', 'c'), ('b', 'c'),
+                               ('c', 'x'), ('a', 'y'), ('x', 'y')])
+        self.samples_like = ([[-1, -1, -1], [-1, +1, -1], [+1, -1, -1], [+1, +1, +1]], 'abc')
+        self.bqm = dimod.BQM({'a': -.5, 'b': -.25, 'c': 1, 'x': .25, 'y': -.75},
+                             {'ab': .5, 'ac': -1, 'bc': -.75, 'cx': .5, 'ay': .25, 'xy': -.5},
+                             1.5, 'SPIN')
+
+        # relabellings, each with a new order for the variables and the samples
+        self.relabellings = [
+            ({'a': 0, 'b': 1, 'c': 2, 'x': 3, 'y': 4}, [0, 1, 2], [0, 1, 2, 3]),
+            ({'a': 'b', 'b': 'a', 'c': 'c', 'x': 'y', 'y': 'x'}, [2, 0, 1], [3, 1, 0, 2]),
+            ({'a': 4, 'b': 3, 'c': 0, 'x': 2, 'y': 1}, [1, 2, 0], [2, 3, 1, 0]),
+            ]
+
+    def relabel(self, mapping, order, rows):
+        samples, variables = self.samples_like
+        samples_like = (np.asarray(samples)[rows][:, order], [mapping[variables[i]] for i in order])
+        return samples_like, nx.relabel_nodes(self.graph, mapping)
+
+    @patch_cache()
+    def test_spec_hash(self, cache):
+        spec_hash, *_ = cache._encode_query(self.samples_like, self.graph)
+        for relabelling in self.relabellings:
+            with self.subTest(relabelling=relabelling):
+                self.assertEqual(cache._encode_query(*self.relabel(*relabelling))[0], spec_hash)
+
+        # a different graph is a different specification
+        graph = self.graph.copy()
+        graph.remove_edge('x', 'y')
+        self.assertNotEqual(cache._encode_query(self.samples_like, graph)[0], spec_hash)
+
+        # as is giving a variable a different role
+        samples, _ = self.samples_like
+        self.assertNotEqual(cache._encode_query((samples, 'cab'), self.graph)[0], spec_hash)
+
+    @patch_cache()
+    def test_retrieve(self, cache):
+        cache.insert_penalty_model(self.bqm, self.samples_like, 2)
+
+        for mapping, order, rows in self.relabellings:
+            with self.subTest(mapping=mapping):
+                samples_like, graph = self.relabel(mapping, order, rows)
+                self.assertEqual(cache.retrieve(samples_like, graph),
+                                 (self.bqm.relabel_variables(mapping, inplace=False), 2))
+
+    @patch_cache()
+    def test_insert(self, cache):
+        for mapping, order, rows in self.relabellings:
+            samples_like, _ = self.relabel(mapping, order, rows)
+            cache.insert_penalty_model(self.bqm.relabel_variables(mapping, inplace=False),
+                                       samples_like, 2)
+
+        self.assertEqual(len(list(cache.iter_penalty_models())), 1)
+        self.assertEqual(cache.retrieve(self.samples_like, self.graph), (self.bqm, 2))
+
+    @patch_cache()
+    def test_flipped(self, cache):
+        # every polarity of a clause is served by one penalty model
+        clause = [s for s in itertools.product([-1, +1], repeat=3) if s != (-1, -1, -1)]
+        bqm = dimod.BQM({'a': -.5, 'b': -.5, 'c': -.5}, {'ab': .5, 'ac': .5, 'bc': .5}, -.5, 'SPIN')
+        cache.insert_penalty_model(bqm, (clause, 'abc'), 2)
+
+        for flips in itertools.product([1, -1], repeat=3):
+            with self.subTest(flips=flips):
+                samples = np.asarray(clause) * flips
+                new, gap = cache.retrieve((samples, 'abc'), 'abc')
+                self.assertEqual(gap, 2)
+
+                expected = bqm.copy()
+                for v, flip in zip('abc', flips):
+                    if flip < 0:
+                        expected.flip_variable(v)
+                self.assertEqual(new, expected)
+
+        # with bounds that are not symmetric, flipping can take a penalty
+        # model out of them. Only the clause with every variable flipped has
+        # linear biases of +.5
+        specs = [((np.asarray(clause) * flips, 'abc'), 'abc')
+                 for flips in itertools.product([1, -1], repeat=3)]
+        penalty_models, misses = cache.retrieve_many(specs, linear_bound=(-.25, 2))
+        self.assertEqual(misses, list(range(7)))
+        bqm, _ = penalty_models[7]
+        self.assertEqual(bqm.linear, {'a': .5, 'b': .5, 'c': .5})
+
+        penalty_models, misses = cache.retrieve_many(specs, linear_bound=(-.5, .5))
+        self.assertEqual(misses, [])
+
+    @patch_cache()
+    def test_flipped_asymmetric_bounds(self, cache):
+        # stored flipped, but found again under the bounds it was made for
+        or_gate = [[0, 0, 0], [0, 1, 1], [1, 0, 1], [1, 1, 1]]
+        bqm = dimod.BQM({0: .5, 1: .5, 2: -1}, {(0, 1): .5, (0, 2): -1, (1, 2): -1}, 1.5, 'SPIN')
+        cache.insert_penalty_model(bqm, or_gate, 2)
+
+        new, gap = cache.retrieve(or_gate, 3, linear_bound=(-2, .5))
+        self.assertEqual(new, bqm)
+        self.assertEqual(gap, 2)
+
+        with self.assertRaises(MissingPenaltyModel):
+            cache.retrieve(or_gate, 3, linear_bound=(-2, .25))
+
+    def test_symmetric(self):
+        # not-all-equal on a complete graph, every relabelling is the same
+        samples = np.array([s for s in itertools.product([False, True], repeat=5)
+                            if 0 < sum(s) < 5])
+        args = (5, tuple(itertools.combinations(range(5), 2)), 5,
+                samples.tobytes(), bytes(8 * len(samples)))
+
+        order, flips = canonical_form(*args)
+        self.assertEqual(sorted(order), list(range(5)))
+        self.assertEqual(flips, (False,) * 5)
+        self.assertIsNone(canonical_form(*args, max_leaves=100))
+
+    def test_migrate(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        database = os.path.join(tmpdir.name, 'cache.db')
+
+        # a database from before penalty models were stored in canonical order
+        with unittest.mock.patch('penaltymodel.database.canonical_form', return_value=None):
+            with PenaltyModelCache(database) as cache:
+                cache.insert_penalty_model(self.bqm, self.samples_like, 2)
+                cache.conn.execute("PRAGMA user_version = 2;")
+        PenaltyModelCache._initialized.discard(database)
+
+        mapping, order, rows = self.relabellings[-1]
+        samples_like, graph = self.relabel(mapping, order, rows)
+        with PenaltyModelCache(database) as cache:
+            self.assertEqual(len(list(cache.iter_penalty_models())), 1)
+            self.assertEqual(cache.retrieve(samples_like, graph),
+                             (self.bqm.relabel_variables(mapping, inplace=False), 2))
+
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.database = os.path.join(tmpdir.name, 'cache.db')
+
+    def test_wal(self):
+        with PenaltyModelCache(self.database) as cache:
+            self.assertEqual(cache.conn.execute("PRAGMA journal_mode;").fetchone()[0], 'wal')
+
+    def test_processes(self):
+        num_workers = 4
+        with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(insert_and_retrieve, self.database, seed)
+                       for seed in range(num_workers)]
+            total = sum(future.result() for future in futures)
+
+        with PenaltyModelCache(self.database) as cache:
+            num_models = len(list(cache.iter_penalty_models()))
+        self.assertGreater(num_models, 0)
+        self.assertLessEqual(num_models, total)
+
+    def test_readers_not_blocked(self):
+        with PenaltyModelCache(self.database) as cache:
+            cache.insert_sampleset([[0, 1]])
+
+        with PenaltyModelCache(self.database, timeout=.01) as writer, \
+                PenaltyModelCache(self.database, timeout=.01) as reader:
+            with writer._transaction(writer.conn):
+                writer.conn.execute(writer.insert_sampleset_statement,
+                                    writer.encode_sampleset([[1, 0]]))
+
+                # readers see the last commit while the write is in progress
+                self.assertEqual(len(list(reader.iter_samplesets())), 1)
+
+                # but other writers time out
+                with unittest.mock.patch.object(PenaltyModelCache, 'retries', 0):
+                    with self.assertRaises(sqlite3.OperationalError):
+                        reader.insert_sampleset([[1, 1]])
+
+        with PenaltyModelCache(self.database) as cache:
+            self.assertEqual(len(list(cache.iter_samplesets())), 2)
@@ -15,17 +15,41 @@
 # developer note: this combines all of the tests from maxgap and mip
 # before we merged. There is likely a lot of redundancy
 
+import concurrent.futures
+import functools
 import itertools
+import multiprocessing
+import pickle
+import threading
+import time
 import unittest
+import unittest.mock
 
 import dimod
 import networkx as nx
+import numpy as np
+import scipy.optimize
 
+import penaltymodel.generation
+from penaltymodel.exceptions import GenerationTimeout
 from penaltymodel.generation import generate, ImpossiblePenaltyModel
 from penaltymodel.utils import table_to_sampleset
 
 MAX_GAP_DELTA = 0.01
 
+backtrack_subtree = penaltymodel.generation.backtrack_subtree
+
+
+def slow_subtree(states, bounds, rows, ground, prefix, *args, **kwargs):
+    """Only search the first subtree, the others run until they are cancelled."""
+    if not any(prefix):
+        return backtrack_subtree(states, bounds, rows, ground, prefix, *args, **kwargs)
+
+    deadline = penaltymodel.generation.Deadline(30, penaltymodel.generation._worker_cancel)
+    while not deadline.expired():
+        time.sleep(.01)
+    raise ImpossiblePenaltyModel
+
 
 class TestGenerate(unittest.TestCase):
     def check_bqm_table(self, bqm, gap, table, decision):
@@ -89,7 +113,8 @@ class TestGenerate(unittest.TestCase):
     def generate_and_check(self, graph, configurations, decision_variables,
                            *, known_classical_gap=0, **kwargs):
 
-        bqm, gap, aux = generate(graph, table_to_sampleset(configurations, decision_variables), **kwargs)
+        bqm, gap, aux = generate(graph, table_to_sampleset(configurations, decision_variables),
+                                 **kwargs)
 
         min_classical_gap = kwargs.get('min_classical_gap', 2)
 
@@ -97,7 +122,7 @@ class TestGenerate(unittest.TestCase):
         # Note: Due to the way MaxGap searches for the maximum gap, if
         #   known_classical_gap == "maximum possible gap", then `gap` can be
         #   slightly smaller than known_classical_gap.
-        self.assertGreaterEqual(round(gap, 9), min_classical_gap)
+        self.assertGreaterEqual(gap, min_classical_gap)
         self.assertGreaterEqual(gap, known_classical_gap - MAX_GAP_DELTA)
 
         # check that the bqm/graph have the same structure
@@ -152,6 +177,21 @@ class TestGenerate(unittest.TestCase):
 
         self.assertAlmostEqual(best_gap, gap)
 
+    def test_min_classical_gap_exact(self):
+        # the LP solution puts the gap a rounding error below 2, which would
+        # keep the penalty model out of the cache's classical_gap >= 2 filter
+        graph = nx.complete_graph(6)
+        configurations = dict.fromkeys(
+            [(-1, -1, -1, +1), (-1, -1, +1, -1), (-1, -1, +1, +1), (-1, +1, -1, -1),
+             (-1, +1, -1, +1), (-1, +1, +1, -1), (-1, +1, +1, +1), (+1, -1, -1, -1),
+             (+1, -1, -1, +1), (+1, -1, +1, -1), (+1, -1, +1, +1), (+1, +1, -1, -1),
+             (+1, +1, -1, +1), (+1, +1, +1, +1)], 0)
+
+        bqm, gap, aux = generate(graph, table_to_sampleset(configurations, [0, 1, 2, 3]),
+                                 min_classical_gap=2)
+
+        self.assertGreaterEqual(gap, 2)
+
     def test_disjoint(self):
         graph = nx.Graph()
         for u, v in itertools.product([0, 1, 2], [3, 4, 5]):
@@ -380,7 +420,6 @@ class TestGenerate(unittest.TestCase):
         configurations = {(1,): -10}
         graph = nx.complete_graph(decision_variables + ['b', 'c'])
 
-
         # Known solution: -2*a - 2*b - 2*c - a*b - a*c - b*c - 1
         known_classical_gap = 8
 
@@ -430,13 +469,38 @@ class TestGenerate(unittest.TestCase):
     def test_NAE3SAT_4cycle(self):
         """A typical use case, an AND gate on a K4."""
         graph = nx.cycle_graph(4)
-        configurations = {config: 0 for config in itertools.product((-1, 1), repeat=3) if len(set(config)) > 1}
+        configurations = {config: 0 for config in itertools.product((-1, 1), repeat=3)
+                          if len(set(config)) > 1}
         decision_variables = (0, 1, 2)
 
         bqm, gap, aux = generate(graph, table_to_sampleset(configurations, decision_variables))
 
         self.check_bqm_table(bqm, gap, configurations, decision_variables)
 
+    def test_more_than_8_variables(self):
+        # an AND gate padded with disconnected auxiliary pairs
+        graph = nx.complete_graph(4)
+        graph.add_edges_from((v, v + 1) for v in range(4, 12, 2))
+        configurations = {(-1, -1, -1): 0,
+                          (-1, +1, -1): 0,
+                          (+1, -1, -1): 0,
+                          (+1, +1, +1): 0}
+        decision_variables = (0, 1, 2)
+
+        self.generate_and_check(graph, configurations, decision_variables)
+
+    def test_more_than_8_variables_connected(self):
+        # an AND gate with a path of auxiliary variables hanging off it
+        graph = nx.complete_graph(4)
+        nx.add_path(graph, range(3, 12))
+        configurations = {(-1, -1, -1): 0,
+                          (-1, +1, -1): 0,
+                          (+1, -1, -1): 0,
+                          (+1, +1, +1): 0}
+        decision_variables = (0, 1, 2)
+
+        self.generate_and_check(graph, configurations, decision_variables)
+
     def test_return_auxiliary_AND_K3(self):
 
         graph = nx.complete_graph(3)
@@ -446,7 +510,8 @@ class TestGenerate(unittest.TestCase):
                           (+1, +1, +1): 0}
         decision_variables = (0, 1, 2)
 
-        bqm, gap, aux_configs = generate(graph, table_to_sampleset(configurations, decision_variables))
+        bqm, gap, aux_configs = generate(graph,
+                                         table_to_sampleset(configurations, decision_variables))
 
         # no aux variables
         self.assertEqual(aux_configs,
@@ -464,7 +529,8 @@ class TestGenerate(unittest.TestCase):
                           (+1, +1, +1): 0}
         decision_variables = (0, 1, 2)
 
-        bqm, gap, aux_configs = generate(graph, table_to_sampleset(configurations, decision_variables))
+        bqm, gap, aux_configs = generate(graph,
+                                         table_to_sampleset(configurations, decision_variables))
 
         for config in configurations:
             sample = dict(zip(decision_variables, config))
@@ -472,3 +538,531 @@ class TestGenerate(unittest.TestCase):
             sample.update(aux_configs[config])
 
             self.assertAlmostEqual(bqm.energy(sample), 0.0)
+
+
+class TestGenerateGap(unittest.TestCase):
+    def test_no_aux_single_lp(self):
+        decision_variables = ['a', 'b', 'c']
+        or_gate = {(-1, -1, -1): 0,
+                   (-1, 1, 1): 0,
+                   (1, -1, 1): 0,
+                   (1, 1, 1): 0}
+        graph = nx.complete_graph(decision_variables)
+
+        # without auxiliary variables, the gap is maximized straight away
+        with unittest.mock.patch.object(penaltymodel.generation.LinearProgram, 'solve',
+                                        side_effect=AssertionError("feasibility solve")):
+            bqm, gap, aux = generate(graph, table_to_sampleset(or_gate, decision_variables))
+
+        self.assertAlmostEqual(gap, 2)
+        self.assertEqual(aux, dict((config, {}) for config in or_gate))
+
+        with unittest.mock.patch.object(penaltymodel.generation.LinearProgram, 'solve',
+                                        side_effect=AssertionError("feasibility solve")):
+            with self.assertRaises(ImpossiblePenaltyModel):
+                generate(graph, table_to_sampleset(or_gate, decision_variables),
+                         min_classical_gap=3)
+
+    def test_target_gap(self):
+        graph = nx.complete_graph(4)
+        configurations = {(-1, -1, -1): 0,
+                          (-1, +1, -1): 0,
+                          (+1, -1, -1): 0,
+                          (+1, +1, +1): 0}
+        samples = table_to_sampleset(configurations, [0, 1, 2])
+
+        bqm, max_gap, _ = generate(graph, samples, min_classical_gap=1)
+
+        # the first model found already meets the minimum, but not infinity
+        for target_gap, maximized in [(1, False), (float('inf'), True)]:
+            with self.subTest(target_gap=target_gap):
+                LinearProgram = penaltymodel.generation.LinearProgram
+                with unittest.mock.patch.object(LinearProgram, 'maximize_gap', autospec=True,
+                                                side_effect=LinearProgram.maximize_gap
+                                                ) as maximize_gap:
+                    bqm, gap, _ = generate(graph, samples, min_classical_gap=1,
+                                           target_gap=target_gap)
+
+                self.assertGreaterEqual(gap, 1)
+                self.assertEqual(maximize_gap.called, maximized)
+                if maximized:
+                    self.assertAlmostEqual(gap, max_gap)
+
+                # the reported gap is the actual gap of the bqm
+                energies = dimod.ExactSolver().sample(bqm).data_vectors['energy']
+                self.assertAlmostEqual(gap, np.unique(energies.round(9))[1])
+
+
+class TestGenerateTimeout(unittest.TestCase):
+    def setUp(self):
+        self.graph = nx.complete_graph(4)
+        self.samples = table_to_sampleset({(-1, -1, -1): 0,
+                                           (-1, +1, -1): 0,
+                                           (+1, -1, -1): 0,
+                                           (+1, +1, +1): 0}, [0, 1, 2])
+
+    def test_cancelled(self):
+        cancel = threading.Event()
+        cancel.set()
+
+        for kwargs in [dict(), dict(method='milp'), dict(workers=2)]:
+            with self.subTest(**kwargs):
+                with self.assertRaises(GenerationTimeout):
+                    generate(self.graph, self.samples, cancel=cancel, **kwargs)
+
+    def test_expired(self):
+        with self.assertRaises(GenerationTimeout):
+            generate(self.graph, self.samples, timeout=0)
+
+        # no auxiliary variables, so the gap maximization is the only solve
+        with self.assertRaises(GenerationTimeout):
+            generate(nx.complete_graph(3), self.samples, timeout=0)
+
+    def test_generous(self):
+        bqm, gap, aux = generate(self.graph, self.samples)
+        self.assertEqual(generate(self.graph, self.samples, timeout=60, cancel=threading.Event()),
+                         (bqm, gap, aux))
+
+    def test_anytime(self):
+        _, max_gap, _ = generate(self.graph, self.samples, min_classical_gap=1)
+
+        with unittest.mock.patch.object(penaltymodel.generation.LinearProgram, 'maximize_gap',
+                                        side_effect=GenerationTimeout):
+            bqm, gap, _ = generate(self.graph, self.samples, min_classical_gap=1, timeout=60)
+
+        self.assertGreaterEqual(gap, 1)
+        self.assertLessEqual(gap, max_gap + 1e-6)
+
+        # the reported gap is the actual gap of the bqm
+        energies = dimod.ExactSolver().sample(bqm).data_vectors['energy']
+        self.assertAlmostEqual(gap, np.unique(energies.round(9))[1])
+
+    def test_deadline_pickle(self):
+        deadline = penaltymodel.generation.Deadline(60, threading.Event())
+        new = pickle.loads(pickle.dumps(deadline))
+        self.assertEqual(new.stop, deadline.stop)
+        self.assertIsNone(new.cancel)
+        self.assertFalse(new.expired())
+
+
+class TestGenerateMany(unittest.TestCase):
+    def setUp(self):
+        self.graph = nx.complete_graph(4)
+        self.tables = [table_to_sampleset({(-1, -1, -1): 0, (-1, +1, -1): 0,
+                                           (+1, -1, -1): 0, (+1, +1, +1): 0},
+                                          [0, 1, 2]),
+                       table_to_sampleset({(-1, -1, -1): 0, (-1, +1, +1): 0,
+                                           (+1, -1, +1): 0, (+1, +1, +1): 0},
+                                          [0, 1, 2]),
+                       ]
+
+    def test_matches_generate(self):
+        tables = self.tables + self.tables[:1]
+        models = penaltymodel.generation.generate_many(self.graph, tables)
+
+        self.assertEqual(len(models), 3)
+        for table, model in zip(tables, models):
+            self.assertEqual(model, generate(self.graph, table))
+        self.assertIsNot(models[2][0], models[0][0])
+
+    def test_dedupe(self):
+        with unittest.mock.patch.object(penaltymodel.generation, 'generate',
+                                        side_effect=generate) as mock:
+            penaltymodel.generation.generate_many(self.graph, self.tables * 3)
+        self.assertEqual(mock.call_count, 2)
+
+    def test_workers(self):
+        self.assertEqual(penaltymodel.generation.generate_many(self.graph, self.tables, workers=2),
+                         penaltymodel.generation.generate_many(self.graph, self.tables))
+
+    def test_reuse_flipped(self):
+        with unittest.mock.patch.object(penaltymodel.generation, 'generate',
+                                        side_effect=generate) as mock:
+            models = penaltymodel.generation.generate_many(self.graph, self.tables,
+                                                           reuse_flipped=True)
+        self.assertEqual(mock.call_count, 1)
+
+        for table, (bqm, gap, aux) in zip(self.tables, models):
+            ground = dimod.ExactSolver().sample(bqm).first.energy
+            for sample in table.samples():
+                state = tuple(sample[v] for v in table.variables)
+                self.assertAlmostEqual(bqm.energy({**sample, **aux[state]}), ground)
+            self.assertEqual(gap, models[0][1])
+
+    def test_spin_reversal(self):
+        and_gate, or_gate = self.tables
+        and_table, and_flipped = penaltymodel.generation.spin_reversal(and_gate)
+        or_table, or_flipped = penaltymodel.generation.spin_reversal(or_gate)
+
+        self.assertEqual(penaltymodel.generation.table_key(and_table),
+                         penaltymodel.generation.table_key(or_table))
+        # between them, everything is flipped
+        self.assertEqual(len(and_flipped) + len(or_flipped), 3)
+        self.assertIs(and_table.vartype, dimod.SPIN)
+
+    def test_impossible(self):
+        xor = table_to_sampleset({(-1, -1, -1): 0, (-1, +1, +1): 0,
+                                  (+1, -1, +1): 0, (+1, +1, -1): 0},
+                                 [0, 1, 2])
+        with self.assertRaises(ImpossiblePenaltyModel):
+            penaltymodel.generation.generate_many(nx.complete_graph(3), [xor])
+
+
+class TestGenerateScipy(TestGenerate):
+    """Rerun all of the generation tests without the persistent HiGHS model."""
+    def setUp(self):
+        patcher = unittest.mock.patch.object(penaltymodel.generation, 'highspy', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestGenerateCuttingPlanes(TestGenerate):
+    """Rerun all of the generation tests with lazily added constraints."""
+    def setUp(self):
+        patcher = unittest.mock.patch(f'{__name__}.generate',
+                                      functools.partial(generate, cutting_planes=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestGenerateNoSymmetryBreaking(TestGenerate):
+    """Rerun all of the generation tests searching every auxiliary state."""
+    def setUp(self):
+        patcher = unittest.mock.patch(f'{__name__}.generate',
+                                      functools.partial(generate, symmetry_breaking=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestGenerateOrdering(TestGenerate):
+    """Rerun all of the generation tests with the other ordering heuristics."""
+    def setUp(self):
+        patcher = unittest.mock.patch(f'{__name__}.generate',
+                                      functools.partial(generate, variable_order='tightest',
+                                                        value_order='static'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_callable(self):
+        graph = nx.complete_graph(4)
+        configurations = {(-1, -1, -1): 0,
+                          (-1, +1, -1): 0,
+                          (+1, -1, -1): 0,
+                          (+1, +1, +1): 0}
+
+        def last(lp, states, candidates):
+            return candidates[-1]
+
+        def reverse(lp, states, decision_state, domain):
+            return domain[::-1]
+
+        self.generate_and_check(graph, configurations, (0, 1, 2),
+                                variable_order=last, value_order=reverse)
+
+    def test_unknown(self):
+        samples = table_to_sampleset({(-1, -1): 0}, [0, 1])
+        with self.assertRaises(ValueError):
+            generate(nx.complete_graph(3), samples, variable_order='random')
+        with self.assertRaises(ValueError):
+            generate(nx.complete_graph(3), samples, value_order='random')
+
+
+class TestGenerateParallel(TestGenerate):
+    """Rerun all of the generation tests with the search split across processes."""
+    def setUp(self):
+        patcher = unittest.mock.patch(f'{__name__}.generate',
+                                      functools.partial(generate, workers=2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_split_depth(self):
+        graph = nx.complete_graph(4)
+        configurations = {(-1, -1, -1): 0,
+                          (-1, +1, -1): 0,
+                          (+1, -1, -1): 0,
+                          (+1, +1, +1): 0}
+
+        for split_depth in [0, 2, 5]:
+            with self.subTest(split_depth=split_depth):
+                self.generate_and_check(graph, configurations, (0, 1, 2), split_depth=split_depth)
+
+    def test_split_fixed(self):
+        # symmetry breaking fixes the auxiliary state of the first decision
+        # state, so the split is on the second one
+        graph = nx.complete_graph(4)
+        configurations = {(-1, -1, -1): 0,
+                          (-1, +1, -1): 0,
+                          (+1, -1, -1): 0,
+                          (+1, +1, +1): 0}
+
+        submit = concurrent.futures.ProcessPoolExecutor.submit
+        for split_depth, num_subtrees in [(1, 2), (2, 4)]:
+            with self.subTest(split_depth=split_depth):
+                with unittest.mock.patch.object(concurrent.futures.ProcessPoolExecutor, 'submit',
+                                                autospec=True, side_effect=submit) as mock:
+                    self.generate_and_check(graph, configurations, (0, 1, 2),
+                                            split_depth=split_depth)
+                self.assertEqual(mock.call_count, num_subtrees)
+
+    def test_cancel_running(self):
+        graph = nx.complete_graph(4)
+        configurations = {(-1, -1, -1): 0,
+                          (-1, +1, -1): 0,
+                          (+1, -1, -1): 0,
+                          (+1, +1, +1): 0}
+
+        t = time.monotonic()
+        with unittest.mock.patch('penaltymodel.generation.backtrack_subtree', slow_subtree):
+            self.generate_and_check(graph, configurations, (0, 1, 2), split_depth=2)
+        self.assertLess(time.monotonic() - t, 10)
+
+        # the subtrees that were still running are stopped with the pool
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+@unittest.skipIf(not hasattr(scipy.optimize, 'milp'), "scipy.optimize.milp requires scipy>=1.9")
+class TestGenerateMILP(TestGenerate):
+    """Rerun all of the generation tests with the MILP formulation."""
+    def setUp(self):
+        patcher = unittest.mock.patch(f'{__name__}.generate',
+                                      functools.partial(generate, method='milp'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @unittest.skip("one indicator per auxiliary state makes this too large for the MILP")
+    def test_more_than_8_variables_connected(self):
+        pass
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            generate(nx.complete_graph(3), table_to_sampleset({(-1, -1): 0}, [0, 1]),
+                     method='guess')
+
+    def test_single_indicator(self):
+        # symmetry breaking leaves the first decision state one auxiliary
+        # state, which HiGHS' presolve fails on
+        graph = nx.Graph([(0, 1), (0, 2), (0, 4), (0, 5), (1, 3), (2, 4), (2, 5), (3, 4), (4, 5)])
+        configurations = {(-1, -1, -1): 0, (1, -1, -1): 0}
+
+        self.generate_and_check(graph, configurations, [0, 1, 2],
+                                min_classical_gap=1, known_classical_gap=6)
+
+
+class TestLinearProgram(unittest.TestCase):
+    def test_abstract(self):
+        class NoGap(penaltymodel.generation.LinearProgram):
+            def _add_rows(self, rows):
+                pass
+
+            def fix(self, i):
+                pass
+
+            def release(self, i):
+                pass
+
+            def _solve(self):
+                return True
+
+        indexer = penaltymodel.generation.Index(['a'], [], [])
+        states = penaltymodel.generation.StateMatrix(indexer, [], np.array([0, 1], dtype=np.int8),
+                                                     np.zeros(2))
+        bounds = indexer.make_bounds(2, (-2, 2), (-1, 1))
+
+        # a backend without _maximize_gap fails up front
+        with self.assertRaises(TypeError):
+            NoGap(states, bounds)
+
+
+@unittest.skipIf(penaltymodel.generation.highspy is None, "highspy is not installed")
+class TestHighsLinearProgram(unittest.TestCase):
+    def test_matches_scipy(self):
+        # a single decision variable, with only the +1 state feasible
+        indexer = penaltymodel.generation.Index(['a'], [], [])
+        states = penaltymodel.generation.StateMatrix(indexer, [], np.array([0, 1], dtype=np.int8),
+                                                     np.zeros(2))
+        bounds = indexer.make_bounds(2, (-2, 2), (-1, 1))
+
+        highs = penaltymodel.generation.HighsLinearProgram(states, bounds)
+        scipy = penaltymodel.generation.ScipyLinearProgram(states, bounds)
+
+        for lp in [highs, scipy]:
+            with self.subTest(lp=type(lp).__name__):
+                self.assertTrue(lp.solve())
+
+                # without fixing the ground state the offset is unbounded
+                self.assertEqual(lp.maximize_gap(), float('inf'))
+
+                lp.fix(1)
+                self.assertTrue(lp.solve())
+                self.assertAlmostEqual(lp.maximize_gap(), 4)
+                np.testing.assert_allclose(lp.x, [4, 2, -2], atol=1e-9)
+
+                lp.release(1)
+                self.assertEqual(lp.maximize_gap(), float('inf'))
+
+    def test_conflict(self):
+        # two decision variables without interactions, fixing the first two
+        # states would need a linear bias of 2.5 on 'a'
+        indexer = penaltymodel.generation.Index(['a', 'b'], [], [])
+        states = penaltymodel.generation.StateMatrix(indexer, [], np.ones(4, dtype=np.int8),
+                                                     np.array([0, 5, 0, 0]))
+        bounds = indexer.make_bounds(2, (-2, 2), (-1, 1))
+
+        lp = penaltymodel.generation.HighsLinearProgram(states, bounds)
+        lp.fix(2)
+        lp.fix(1)
+        self.assertTrue(lp.solve())
+        lp.fix(0)
+        self.assertFalse(lp.solve())
+
+        conflict = lp.conflict()
+        self.assertLessEqual(conflict, {0, 1, 2})
+        self.assertIn(0, conflict)
+
+        # the rows not in the conflict are not needed for infeasibility
+        for i in {0, 1, 2} - conflict:
+            lp.release(i)
+        self.assertFalse(lp.solve())
+
+
+class TestSplitTable(unittest.TestCase):
+    def test_product(self):
+        graph = nx.Graph([(0, 1), (2, 3)])
+        graph.add_node(4)
+        samples = np.array([[-1, -1], [-1, +1], [+1, -1], [+1, +1]])
+
+        blocks = penaltymodel.generation.split_table(graph, [0, 2], samples, np.zeros(4))
+
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual([sorted(subgraph.nodes) for subgraph, _, _ in blocks],
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual([decision for _, decision, _ in blocks], [[0], [2], []])
+        np.testing.assert_array_equal(blocks[0][2], [[-1], [+1]])
+        np.testing.assert_array_equal(blocks[1][2], [[-1], [+1]])
+
+    def test_not_product(self):
+        graph = nx.Graph([(0, 1), (2, 3)])
+        samples = np.array([[-1, -1], [+1, +1]])
+
+        self.assertIsNone(penaltymodel.generation.split_table(graph, [0, 2], samples, np.zeros(2)))
+
+    def test_different_energies(self):
+        graph = nx.Graph([(0, 1), (2, 3)])
+        samples = np.array([[-1, -1], [-1, +1], [+1, -1], [+1, +1]])
+
+        self.assertIsNone(penaltymodel.generation.split_table(graph, [0, 2], samples, np.arange(4)))
+
+    def test_connected(self):
+        graph = nx.path_graph(4)
+        samples = np.array([[-1, -1], [+1, +1]])
+
+        self.assertIsNone(penaltymodel.generation.split_table(graph, [0, 3], samples, np.zeros(2)))
+
+
+class TestGenerateNoDecomposition(TestGenerate):
+    """Rerun all of the generation tests without splitting disconnected graphs."""
+    def setUp(self):
+        patcher = unittest.mock.patch(f'{__name__}.generate',
+                                      functools.partial(generate, decompose=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestAuxiliaryDomains(unittest.TestCase):
+    def test_star(self):
+        # the leaves are interchangeable, so only the number at +1 matters
+        graph = nx.star_graph(3)
+
+        domains = penaltymodel.generation.auxiliary_domains(graph, [0], [1, 2, 3], gauge=False)
+        self.assertEqual(domains, [[0, 1, 3, 7]])
+
+        domains = penaltymodel.generation.auxiliary_domains(graph, [0], [1, 2, 3], gauge=True)
+        self.assertEqual(domains, [[0], [0, 1, 3, 7]])
+
+    def test_no_automorphisms(self):
+        # each auxiliary is adjacent to a different decision variable
+        graph = nx.path_graph(4)
+
+        domains = penaltymodel.generation.auxiliary_domains(graph, [0, 3], [1, 2], gauge=False)
+        self.assertEqual(domains, [])
+
+    def test_cached(self):
+        graph = nx.relabel_nodes(nx.complete_graph(5), dict(enumerate('abcde')))
+        domains = penaltymodel.generation.auxiliary_domains(graph, ['a', 'b', 'c'], ['d', 'e'],
+                                                            gauge=False)
+
+        # a relabelled copy has the same topology, so it does not search again
+        graph = nx.relabel_nodes(graph, str.upper)
+        with unittest.mock.patch.object(nx.algorithms.isomorphism, 'GraphMatcher',
+                                        side_effect=AssertionError("searched again")):
+            new = penaltymodel.generation.auxiliary_domains(graph, ['A', 'B', 'C'], ['D', 'E'],
+                                                            gauge=False)
+
+        self.assertEqual(new, domains)
+
+    def test_no_auxiliaries(self):
+        graph = nx.complete_graph(3)
+
+        domains = penaltymodel.generation.auxiliary_domains(graph, [0, 1, 2], [], gauge=True)
+        self.assertEqual(domains, [])
+
+
+class TestStates(unittest.TestCase):
+    def test_all_possible(self):
+        for num_variables in [0, 1, 3, 9, 12]:
+            with self.subTest(num_variables=num_variables):
+                states = penaltymodel.generation.all_possible(num_variables)
+                self.assertEqual(states.shape, (1 << num_variables, num_variables))
+                self.assertEqual(len(set(map(tuple, states))), 1 << num_variables)
+
+    def test_iter_states(self):
+        chunks = list(penaltymodel.generation.iter_states(10, [(0, 1), (3, 9)], chunk_size=100))
+
+        self.assertEqual(len(chunks), 11)
+        self.assertTrue(all(chunk.shape == (100, 12) for chunk in chunks[:-1]))
+
+        states = np.vstack(chunks)
+        np.testing.assert_array_equal(states[:, :10], penaltymodel.generation.all_possible(10))
+        np.testing.assert_array_equal(states[:, 10], states[:, 0] * states[:, 1])
+        np.testing.assert_array_equal(states[:, 11], states[:, 3] * states[:, 9])
+
+    def test_shared_columns(self):
+        indexer = penaltymodel.generation.Index([0, 1], [2], [(0, 1), (1, 2)])
+        feasible = np.array([1, 0, 0, 1], dtype=np.int8)
+        StateMatrix = penaltymodel.generation.StateMatrix
+        states = StateMatrix(indexer, [(0, 1), (1, 2)], feasible, np.zeros(4))
+        other = StateMatrix(indexer, [(0, 1), (1, 2)], 1 - feasible, np.ones(4))
+
+        self.assertIs(states.columns, other.columns)
+        self.assertFalse(states.columns.flags.writeable)
+
+        # the cached columns match the ones computed on demand
+        with unittest.mock.patch.object(StateMatrix, 'max_cached_variables', 0):
+            uncached = StateMatrix(indexer, [(0, 1), (1, 2)], feasible, np.zeros(4))
+        self.assertIsNone(uncached.columns)
+
+        indices = np.arange(8)
+        for a, b in zip(states.rows(indices), uncached.rows(indices)):
+            np.testing.assert_array_equal(a, b)
+
+    def test_sparse_rows(self):
+        indexer = penaltymodel.generation.Index([0, 1], [2], [(0, 1), (1, 2)])
+        states = penaltymodel.generation.StateMatrix(indexer, [(0, 1), (1, 2)],
+                                                     np.array([1, 0, 0, 1], dtype=np.int8),
+                                                     np.zeros(4))
+
+        indices = np.array([7, 0, 2, 5, 1])
+        A, b = states.rows(indices)
+        for sign in [1, -1]:
+            with self.subTest(sign=sign):
+                sparse, sparse_b = states.sparse_rows(indices, sign=sign)
+                np.testing.assert_array_equal(sparse.toarray(), sign * A)
+                np.testing.assert_array_equal(sparse_b, b)
+                self.assertEqual(sparse.nnz, np.count_nonzero(A))
+
+    def test_pack_states(self):
+        states = penaltymodel.generation.all_possible(11)
+        packed = penaltymodel.generation.pack_states(states)
+        np.testing.assert_array_equal(packed, np.arange(1 << 11))
+        np.testing.assert_array_equal(penaltymodel.generation.spin_configurations(packed, 11),
+                                      states)
@@ -13,20 +13,24 @@
 # limitations under the License.
 
 import itertools
+import threading
 import unittest
 import unittest.mock
 
 import dimod
 import networkx as nx
 
-from penaltymodel import get_penalty_model
-from penaltymodel.database import isolated_cache
+import penaltymodel.generation
+
+from penaltymodel import GenerationTimeout, get_penalty_model, get_penalty_models
+from penaltymodel.database import PenaltyModelCache, isolated_cache
 
 
 class TestGetPenaltyModel(unittest.TestCase):
     @isolated_cache()
     def test_different_energy_levels(self):
-        samples_like = dimod.SampleSet.from_samples([[-1, -1, -1], [1, 1, 1]], energy=[0, .5], vartype='BINARY')
+        samples_like = dimod.SampleSet.from_samples([[-1, -1, -1], [1, 1, 1]], energy=[0, .5],
+                                                    vartype='BINARY')
 
         bqm, gap = get_penalty_model(samples_like)
 
@@ -35,7 +39,8 @@ class TestGetPenaltyModel(unittest.TestCase):
 
     @isolated_cache()
     def test_different_energy_levels_graph_like(self):
-        samples_like = dimod.SampleSet.from_samples([[-1, -1, -1], [1, 1, 1]], energy=[0, .5], vartype='BINARY')
+        samples_like = dimod.SampleSet.from_samples([[-1, -1, -1], [1, 1, 1]], energy=[0, .5],
+                                                    vartype='BINARY')
 
         bqm, gap = get_penalty_model(samples_like, graph_like=nx.complete_graph(3))
 
@@ -68,6 +73,89 @@ class TestGetPenaltyModel(unittest.TestCase):
         for sample in ground.samples():
             self.assertEqual(sample['d'] > 0 and sample['b'] > 0, sample['f'] > 0)
 
+    @isolated_cache()
+    def test_subgraph_labelled_workers(self):
+        G = nx.Graph(itertools.product('abc', 'def'))
+
+        bqm, gap = get_penalty_model(([[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]], 'dbf'), G,
+                                     workers=2)
+
+        ground = dimod.keep_variables(dimod.ExactSolver().sample(bqm), 'dbf').lowest().aggregate()
+
+        self.assertEqual(len(ground), 4)
+        for sample in ground.samples():
+            self.assertEqual(sample['d'] > 0 and sample['b'] > 0, sample['f'] > 0)
+
+    @isolated_cache()
+    def test_cache_relabelled(self):
+        G = nx.Graph(itertools.product('abc', 'def'))
+
+        bqm, gap = get_penalty_model(([[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]], 'dbf'), G)
+
+        # the same AND gate, with the variables renamed and given in another order
+        G = nx.relabel_nodes(G, dict(zip('abcdef', 'uvwxyz')))
+        with unittest.mock.patch('penaltymodel.interface.generate') as mock:
+            mock.side_effect = Exception('boom')
+            new, new_gap = get_penalty_model(([[0, 0, 0], [0, 0, 1], [0, 1, 0], [1, 1, 1]], 'zxv'),
+                                             G)
+
+        self.assertEqual(new_gap, gap)
+        self.assertEqual(new.variables ^ G.nodes, set())
+
+        ground = dimod.keep_variables(dimod.ExactSolver().sample(new), 'xvz').lowest().aggregate()
+        self.assertEqual(len(ground), 4)
+        for sample in ground.samples():
+            self.assertEqual(sample['x'] > 0 and sample['v'] > 0, sample['z'] > 0)
+
+    @isolated_cache()
+    def test_cut_short_not_cached(self):
+        and_gate = [[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]]
+        cancel = threading.Event()
+
+        def maximize_gap(lp):
+            # cancelled while maximizing the gap
+            cancel.set()
+            raise GenerationTimeout
+
+        with unittest.mock.patch.object(penaltymodel.generation.LinearProgram, 'maximize_gap',
+                                        maximize_gap):
+            bqm, gap = get_penalty_model(and_gate, nx.complete_graph(4), cancel=cancel)
+
+        # the penalty model is returned, but not cached
+        self.assertGreaterEqual(gap, 2)
+        with PenaltyModelCache() as cache:
+            self.assertEqual(list(cache.iter_penalty_models()), [])
+
+        bqm, gap = get_penalty_model(and_gate, nx.complete_graph(4))
+        with PenaltyModelCache() as cache:
+            self.assertEqual(len(list(cache.iter_penalty_models())), 1)
+
+    @isolated_cache()
+    def test_cache_min_classical_gap(self):
+        # the LP puts the gap of this one a rounding error below 2
+        table = [s for s in itertools.product([0, 1], repeat=4)
+                 if s not in [(0, 0, 0, 0), (1, 1, 1, 0)]]
+
+        with unittest.mock.patch('penaltymodel.interface.generate',
+                                 side_effect=penaltymodel.generation.generate) as mock:
+            models = [get_penalty_model(table, nx.complete_graph(6)) for _ in range(3)]
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertGreaterEqual(models[0][1], 2)
+        self.assertEqual(models[1], models[0])
+
+    @isolated_cache()
+    def test_cache_asymmetric_bounds(self):
+        or_gate = [[0, 0, 0], [0, 1, 1], [1, 0, 1], [1, 1, 1]]
+
+        bqm, gap = get_penalty_model(or_gate, linear_bound=(-2, .5), min_classical_gap=1)
+
+        with unittest.mock.patch('penaltymodel.interface.generate') as mock:
+            mock.side_effect = Exception('boom')
+            new = get_penalty_model(or_gate, linear_bound=(-2, .5), min_classical_gap=1)
+
+        self.assertEqual((bqm, gap), new)
+
     @isolated_cache()
     def test_unorded_range_labels(self):
         # NAE
@@ -86,3 +174,90 @@ class TestGetPenaltyModel(unittest.TestCase):
         self.assertEqual(len(ground), 6)
         for sample in ground.samples():
             self.assertTrue(len(set(sample.values())) > 1)
+
+
+class TestGetPenaltyModels(unittest.TestCase):
+    @isolated_cache()
+    def test_matches_single(self):
+        and_gate = [[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]]
+        buffer = [[0, 0, 0], [0, 1, 0], [1, 0, 1], [1, 1, 1]]
+
+        models = get_penalty_models([and_gate, buffer, and_gate], use_cache=False)
+
+        self.assertEqual(len(models), 3)
+        self.assertEqual(models[0], get_penalty_model(and_gate, use_cache=False))
+        self.assertEqual(models[1], get_penalty_model(buffer, use_cache=False))
+        self.assertEqual(models[2], models[0])
+        self.assertIsNot(models[2][0], models[0][0])
+
+    @isolated_cache()
+    def test_flipped(self):
+        and_gate = [[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]]
+        or_gate = [[0, 0, 0], [0, 1, 1], [1, 0, 1], [1, 1, 1]]  # and with everything flipped
+        nand_gate = [[0, 0, 1], [0, 1, 1], [1, 0, 1], [1, 1, 0]]
+
+        with unittest.mock.patch('penaltymodel.generation.generate',
+                                 side_effect=penaltymodel.generation.generate) as mock:
+            models = get_penalty_models([and_gate, or_gate, nand_gate], use_cache=False)
+
+        self.assertEqual(mock.call_count, 1)
+        for table, (bqm, gap) in zip([and_gate, or_gate, nand_gate], models):
+            ground = dimod.ExactSolver().sample(bqm).lowest().aggregate()
+            self.assertEqual(sorted(((ground.record.sample + 1) // 2).tolist()), table)
+            self.assertEqual(gap, models[0][1])
+
+        # asymmetric bounds are not preserved by flipping
+        with unittest.mock.patch('penaltymodel.generation.generate',
+                                 side_effect=penaltymodel.generation.generate) as mock:
+            get_penalty_models([and_gate, or_gate], linear_bound=(-2, 1), use_cache=False)
+        self.assertEqual(mock.call_count, 2)
+
+    @isolated_cache()
+    def test_dedupe(self):
+        and_gate = [[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]]
+        spin_and_gate = [[-1, -1, -1], [-1, +1, -1], [+1, -1, -1], [+1, +1, +1]]
+
+        with unittest.mock.patch('penaltymodel.generation.generate',
+                                 side_effect=penaltymodel.generation.generate) as mock:
+            models = get_penalty_models([and_gate, spin_and_gate, and_gate])
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(models[0], models[1])
+
+    @isolated_cache()
+    def test_cache(self):
+        samples_likes = [([[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]], 'dbf'),
+                         ([[0, 0, 0], [0, 1, 0], [1, 0, 1], [1, 1, 1]], 'dbf'),
+                         ([[0, 1], [1, 0]], 'xy')]
+
+        models = get_penalty_models(samples_likes)
+
+        # now do it again, but make sure we use the cache
+        with unittest.mock.patch('penaltymodel.interface.generate_many') as mock:
+            mock.side_effect = Exception('boom')
+            self.assertEqual(get_penalty_models(samples_likes), models)
+            self.assertEqual(get_penalty_model(samples_likes[1]), models[1])
+
+    @isolated_cache()
+    def test_workers(self):
+        G = nx.Graph(itertools.product('abc', 'def'))
+        samples_likes = [([[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]], 'dbf'),
+                         ([[0, 0, 0], [0, 1, 1], [1, 0, 1], [1, 1, 1]], 'dbf')]
+
+        models = get_penalty_models(samples_likes, G, workers=2, use_cache=False)
+
+        # the gap maximization can settle on a different optimum, so compare
+        # the gaps and the ground states rather than the biases
+        for (bqm, gap), (expected, expected_gap) in zip(
+                models, get_penalty_models(samples_likes, G, use_cache=False)):
+            self.assertAlmostEqual(gap, expected_gap)
+
+            ground = dimod.keep_variables(dimod.ExactSolver().sample(bqm), 'dbf').lowest()
+            expected_ground = dimod.keep_variables(dimod.ExactSolver().sample(expected),
+                                                   'dbf').lowest()
+            self.assertEqual(sorted(ground.aggregate().record.sample.tolist()),
+                             sorted(expected_ground.aggregate().record.sample.tolist()))
+
+    @isolated_cache()
+    def test_empty(self):
+        self.assertEqual(get_penalty_models([]), [])
@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import unittest
 
 import networkx as nx
+import numpy as np
 import penaltymodel
 
+from penaltymodel.utils import spin_reversals
+
 
 class TestAsGraph(unittest.TestCase):
     def test_int(self):
@@ -39,3 +43,33 @@ class TestAsGraph(unittest.TestCase):
 
         P6 = nx.path_graph(6)
         self.assertIs(P6, penaltymodel.as_graph(P6))
+
+
+class TestSpinReversals(unittest.TestCase):
+    def test_majority(self):
+        # a clause, x or y or not z
+        samples = np.array([s for s in itertools.product([0, 1], repeat=3) if s != (0, 0, 1)],
+                           dtype=bool)
+        reversals = spin_reversals(samples)
+        self.assertEqual(len(reversals), 1)
+        np.testing.assert_array_equal(reversals[0], [True, True, False])
+
+    def test_tied(self):
+        # and gate, the inputs have as many ones as zeros
+        samples = np.array([[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]], dtype=bool)
+        reversals = spin_reversals(samples)
+        self.assertEqual(sorted(map(tuple, reversals)),
+                         [(False, False, False), (False, True, False),
+                          (True, False, False), (True, True, False)])
+
+        self.assertEqual(len(spin_reversals(samples, max_tied=1)), 1)
+        np.testing.assert_array_equal(spin_reversals(samples, max_tied=1)[0], [False, False, False])
+
+    def test_flipped(self):
+        # the same flipped tables, however the table is flipped to start with
+        samples = np.array([[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 1]], dtype=bool)
+        tables = {frozenset(map(tuple, samples ^ flips)) for flips in spin_reversals(samples)}
+        for flips in itertools.product([False, True], repeat=3):
+            flipped = samples ^ np.array(flips)
+            self.assertEqual({frozenset(map(tuple, flipped ^ f)) for f in spin_reversals(flipped)},
+                             tables)